@@ -0,0 +1,241 @@
+"""
+Versioned artifact of a fitted pipeline
+
+Layout of an artifact directory:
+    manifest.json       version, feature order, columns.json, models, Ridge weights,
+                        parity check with the fitted model
+    vocab.json          CategoryVocab
+    beta_encoders.npz   lookup arrays of every BetaEncoder
+    xgb.ubj / lgbm.txt / cat.cbm
+                        base learners in their native formats
+
+Nothing is read before it is used, and the booster packages are only
+imported when their model is loaded, so a scoring process does not pay
+for the training stack (sklearn, optuna, ...).
+"""
+import os
+import json
+import importlib
+from datetime import datetime
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from .encoder import BetaEncoder, CategoryVocab
+from .inference import StackPredictor, fitted_parts
+
+ARTIFACT_VERSION = 1
+## largest log price difference between the saved and the fitted model on the check rows
+PARITY_TOLERANCE = 1e-6
+
+NATIVE_FORMATS = {
+    'XGBRegressor': ('xgboost', 'ubj'),
+    'LGBMRegressor': ('lightgbm', 'txt'),
+    'CatBoostRegressor': ('catboost', 'cbm'),
+}
+
+
+def save_native(model, path_prefix: str) -> Dict[str, str]:
+    """
+    Save a base learner in its native format
+
+    Returns:
+        Dict[str, str]: file and library of the saved model
+    """
+    library, ext = NATIVE_FORMATS[type(model).__name__]
+    path = f"{path_prefix}.{ext}"
+    if library == 'xgboost':
+        model.get_booster().save_model(path)
+    elif library == 'lightgbm':
+        model.booster_.save_model(path)
+    else:
+        model.save_model(path)
+    return {'file': os.path.basename(path), 'library': library}
+
+
+def save_artifact(
+        path: str,
+        model,
+        vocab: CategoryVocab,
+        beta_encoders: Dict[str, BetaEncoder],
+        cols: dict,
+        columns: List[str],
+        x_check: pd.DataFrame = None
+    ) -> None:
+    """
+    Save a fitted pipeline as an artifact directory
+
+    Args:
+        path (str): artifact directory
+        model: fitted ParallelStacking / StackingRegressor
+        vocab (CategoryVocab): fitted label encoding vocabulary
+        beta_encoders (dict): fitted BetaEncoder of every categorical column
+        cols (dict): content of columns.json
+        columns (List[str]): feature order of the model
+        x_check (pd.DataFrame): encoded rows on which the saved artifact is
+            compared with the model in memory, the result is kept in the
+            manifest under 'parity' and a mismatch is reported, skipped if None
+    """
+    os.makedirs(path, exist_ok=True)
+    estimators, final_estimator = fitted_parts(model)
+
+    models = {}
+    for name, estimator in estimators.items():
+        models[name] = save_native(estimator, os.path.join(path, name))
+        library = importlib.import_module(models[name]['library'])
+        models[name]['version'] = library.__version__
+
+    vocab.save(os.path.join(path, "vocab.json"))
+
+    arrays, encoders = {}, {}
+    for col, encoder in beta_encoders.items():
+        arrays[f"{col}.sums"], arrays[f"{col}.counts"] = encoder.sums, encoder.counts
+        encoders[col] = {
+            'prior_mean': float(encoder.prior_mean),
+            'categories': None if encoder.categories is None else encoder.categories.tolist()
+        }
+    np.savez(os.path.join(path, "beta_encoders.npz"), **arrays)
+
+    manifest = {
+        'version': ARTIFACT_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'columns': list(columns),
+        'cols': cols,
+        'models': models,
+        'final': {
+            'names': list(estimators),
+            'coef': np.ravel(final_estimator.coef_).tolist(),
+            'intercept': float(np.ravel(final_estimator.intercept_)[0])
+        },
+        'beta_encoders': encoders
+    }
+    write_manifest(path, manifest)
+
+    if x_check is not None:
+        ## both sides get the float32 input of the inference engine, so only
+        ## the serialization is compared, not the float64 -> float32 rounding
+        x_32 = x_check[list(columns)].astype(np.float32)
+        diff = np.abs(Artifact(path).predict(x_32) - model.predict(x_32))
+        manifest['parity'] = {
+            'rows': len(diff),
+            'max_abs_diff': float(diff.max()) if len(diff) else 0.0,
+            'tolerance': PARITY_TOLERANCE
+        }
+        write_manifest(path, manifest)
+        if manifest['parity']['max_abs_diff'] > PARITY_TOLERANCE:
+            print(
+                f"WARNING: saved artifact predicts up to {manifest['parity']['max_abs_diff']} "
+                f"away from the fitted model on {int((diff > PARITY_TOLERANCE).sum())} "
+                f"of {len(diff)} check rows, see {path}/manifest.json"
+            )
+
+
+def write_manifest(path: str, manifest: dict) -> None:
+    """
+    Write manifest.json of an artifact directory
+    """
+    with open(os.path.join(path, "manifest.json"), 'w', encoding='utf-8') as json_file:
+        json.dump(manifest, json_file, ensure_ascii=False, indent=4, default=str)
+
+
+class Artifact:
+    """
+    Lazily loaded fitted pipeline
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, "manifest.json"), encoding='utf-8') as json_file:
+            self.manifest = json.load(json_file)
+        if self.manifest['version'] != ARTIFACT_VERSION:
+            raise ValueError(
+                f"Artifact version {self.manifest['version']} is not supported, "
+                f"expected {ARTIFACT_VERSION}"
+            )
+        self.columns = self.manifest['columns']
+        self.cols = self.manifest['cols']
+        ## Ridge weight of every base learner, by name
+        final = self.manifest['final']
+        self.coef = dict(zip(final.get('names', list(self.manifest['models'])), final['coef']))
+        self.intercept = self.manifest['final']['intercept']
+        self._vocab = None
+        self._beta_encoders = None
+        self._models = {}
+        self._predictor = None
+
+
+    @property
+    def vocab(self) -> CategoryVocab:
+        """
+        label encoding vocabulary, loaded on first use
+        """
+        if self._vocab is None:
+            self._vocab = CategoryVocab.load(os.path.join(self.path, "vocab.json"))
+        return self._vocab
+
+
+    @property
+    def beta_encoders(self) -> Dict[str, BetaEncoder]:
+        """
+        beta encoders, loaded on first use
+        """
+        if self._beta_encoders is None:
+            arrays = np.load(os.path.join(self.path, "beta_encoders.npz"))
+            self._beta_encoders = {
+                col: BetaEncoder.from_arrays(
+                    col, arrays[f"{col}.sums"], arrays[f"{col}.counts"],
+                    state['prior_mean'], state['categories']
+                ) for col, state in self.manifest['beta_encoders'].items()
+            }
+        return self._beta_encoders
+
+
+    def model(self, name: str):
+        """
+        native booster of a base learner, loaded (and its package imported) on first use
+        """
+        if name not in self._models:
+            info = self.manifest['models'][name]
+            library = importlib.import_module(info['library'])
+            file_path = os.path.join(self.path, info['file'])
+            if info['library'] == 'catboost':
+                self._models[name] = library.CatBoost().load_model(file_path)
+            else:
+                self._models[name] = library.Booster(model_file=file_path)
+        return self._models[name]
+
+
+    def encode(self, x_data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Encode the feature + categorical columns into the model columns
+        """
+        cat_cols = self.cols['cat_cols']
+        x_data = x_data[self.cols['feat_cols'] + cat_cols].copy()
+        x_data[cat_cols] = self.vocab.transform(x_data)
+
+        for col, encoder in self.beta_encoders.items():
+            x_data[f"{col}_mean"] = encoder.transform(x_data, 'mean')
+        return x_data[self.columns]
+
+
+    def predictor(self, n_threads: int = -1) -> StackPredictor:
+        """
+        Inference engine of the boosters + Ridge, built on first use
+        """
+        if self._predictor is None or self._predictor.n_threads != n_threads:
+            self._predictor = StackPredictor.from_artifact(self, n_threads)
+        return self._predictor
+
+
+    def predict_base(self, x_data: np.ndarray) -> np.ndarray:
+        """
+        Log price predictions of every base learner, one column per model
+        """
+        return self.predictor().predict_base(x_data)
+
+
+    def predict(self, x_data) -> np.ndarray:
+        """
+        Log price prediction of the encoded model columns
+        """
+        if isinstance(x_data, pd.DataFrame):
+            x_data = x_data[self.columns].to_numpy(dtype=np.float32)
+        return self.predictor().predict(x_data)
@@ -0,0 +1,445 @@
+"""
+Benchmark of the feature builders, the encoders, the model fitting and inference
+
+Synthetic listings around the six cities and synthetic facility tables
+are generated once per scale (same seed, same files), then every case runs
+in a fresh process, so its peak RSS is its own. The best of --repeat runs
+is kept. The results go to a JSON file which can be used as the baseline
+of the next run, the cases slower (or bigger) than the baseline by more
+than --tolerance are flagged and the exit code is 1.
+
+Example:
+    python -m src.benchmark --targets 10000 100000 --output reports/baseline.json
+    python -m src.benchmark --targets 10000 100000 --baseline reports/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import pandas as pd
+from .utils.data_utils import (
+    load_data,
+    load_projected,
+    project_coordinates
+)
+from .utils.profiling import peak_rss_mb
+from .utils.spatial_utils import to_xy
+
+CITIES = {
+    '台北市': (25.04, 121.55),
+    '新北市': (25.01, 121.46),
+    '桃園市': (24.99, 121.30),
+    '台中市': (24.15, 120.67),
+    '台南市': (22.99, 120.21),
+    '高雄市': (22.63, 120.30),
+}
+
+CATEGORIES = {
+    '使用分區': ['住', '商', '工', '農', '其他'],
+    '主要用途': ['住家用', '商業用', '辦公用', '工業用', '其他'],
+    '主要建材': ['鋼筋混凝土造', '鋼骨造', '加強磚造', '其他'],
+    '建物型態': ['住宅大樓(11層含以上有電梯)', '華廈(10層含以下有電梯)', '公寓(5樓含以下無電梯)', '透天厝'],
+}
+
+ROUND_PARAMS = {
+    'XGBRegressor': 'n_estimators',
+    'CatBoostRegressor': 'iterations',
+    'LGBMRegressor': 'num_iterations',
+}
+
+MIN_RSS_GROWTH_MB = 16
+
+
+def load_cols() -> dict:
+    """
+    content of columns.json
+    """
+    with open(f"{os.getcwd()}/columns.json", encoding="utf-8") as json_file:
+        return json.load(json_file)
+
+
+def around_cities(rng: np.random.Generator, n: int, spread: float) -> Tuple[np.ndarray, ...]:
+    """
+    city, lat, lng of n points scattered around the city centres
+    """
+    names = np.array(list(CITIES))
+    centres = np.array(list(CITIES.values()))
+    city = rng.integers(0, len(names), n)
+    lat = centres[city, 0] + rng.normal(0, spread, n)
+    lng = centres[city, 1] + rng.normal(0, spread, n)
+    return names[city], lat, lng
+
+
+def make_listings(n: int, seed: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    n synthetic listings with the raw and the feature columns, and their 單價
+    """
+    rng = np.random.default_rng(seed)
+    cols = load_cols()
+    city, lat, lng = around_cities(rng, n, 0.05)
+    x, y = project_coordinates(lng, lat, "EPSG:4326", "EPSG:3826")
+
+    listings = pd.DataFrame({
+        'ID': np.char.add('BM-', np.arange(n).astype(str)),
+        '縣市': city,
+        '鄉鎮市區': np.char.add(city, np.char.add('區', rng.integers(0, 30, n).astype(str))),
+    })
+    for col, values in CATEGORIES.items():
+        listings[col] = np.array(values)[rng.integers(0, len(values), n)]
+    for col in cols['feat_cols']:
+        if col.startswith('縣市_'):
+            listings[col] = (city == col.split('_', 1)[1]).astype(np.int8)
+        else:
+            listings[col] = rng.lognormal(0, 1, n)
+    listings['橫坐標'], listings['縱坐標'] = x, y
+    listings['單價'] = np.exp(rng.normal(0, 0.3, n) + (city == '台北市'))
+    return listings, listings[['單價']]
+
+
+def make_facilities(n: int, seed: int = 1) -> pd.DataFrame:
+    """
+    n synthetic facilities with lat / lng, like the external_data tables
+    """
+    rng = np.random.default_rng(seed)
+    _, lat, lng = around_cities(rng, n, 0.1)
+    return pd.DataFrame({'lat': lat, 'lng': lng})
+
+
+def prepare(workdir: str, n_targets: int, n_facilities: int = None) -> Dict[str, str]:
+    """
+    csv files of a scale, generated only if they do not exist yet
+    """
+    os.makedirs(workdir, exist_ok=True)
+    paths = {
+        'targets': os.path.join(workdir, f"targets_{n_targets}.csv"),
+        'prices': os.path.join(workdir, f"prices_{n_targets}.csv"),
+    }
+    if not os.path.exists(paths['targets']):
+        listings, prices = make_listings(n_targets)
+        listings.to_csv(paths['targets'], index=False)
+        prices.to_csv(paths['prices'], index=False)
+
+    if n_facilities is not None:
+        paths['facilities'] = os.path.join(workdir, f"facilities_{n_facilities}.csv")
+        if not os.path.exists(paths['facilities']):
+            make_facilities(n_facilities).to_csv(paths['facilities'], index=False)
+    return paths
+
+
+def encoded_frames(paths: Dict[str, str]) -> tuple:
+    """
+    select_features output of the synthetic listings, as train / test / private
+    """
+    from .preproc import PreProc
+    cols = load_cols()
+    preproc = PreProc(paths['targets'], paths['targets'], paths['prices'], 'train', cols)
+    x_data, y_data = preproc.select_features(**cols)
+    test_x = x_data.drop(columns=['單價'])
+    return preproc, cols, x_data, y_data['單價'], test_x
+
+
+def case_n_facilities(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    NFacilities.main, three radii
+    """
+    from .features.n_facilities_v2 import NFacilities
+    nfac = NFacilities(paths['facilities'], paths['targets'], [500, 1000, 2000])
+    return nfac.main, len(nfac.target)
+
+
+def case_mean_dist(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    MeanDist, KD-tree build + k nearest query
+    """
+    from .features.mean_dist import MeanDist
+    mean_dist = MeanDist(paths['facilities'], paths['targets'], 3, 'bench')
+
+    def run() -> None:
+        mean_dist.tree = None
+        mean_dist.update_dataframe('avg_distances_bench')
+    return run, len(mean_dist.target)
+
+
+def case_edu_nearest(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    PreprocessingEdu.find_nearest_facilities, batched over every target
+    """
+    from .features.preprocessing_edu_v2 import PreprocessingEdu
+    edu = PreprocessingEdu()
+    units = to_xy(load_data(paths['targets'], usecols=['橫坐標', '縱坐標']))
+    facilities = load_projected(paths['facilities'])
+    return lambda: edu.find_nearest_facilities(units, facilities), len(units)
+
+
+def case_edu_nearest_one(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    PreprocessingEdu.find_nearest_facility, one call per target, first 1000 targets
+    """
+    from .features.preprocessing_edu_v2 import PreprocessingEdu
+    edu = PreprocessingEdu()
+    units = to_xy(load_data(paths['targets'], usecols=['橫坐標', '縱坐標']))[:1000]
+    facilities = load_projected(paths['facilities'])
+
+    def run() -> None:
+        for unit_x, unit_y in units:
+            edu.find_nearest_facility(unit_x, unit_y, facilities)
+    return run, len(units)
+
+
+def case_beta_encoder(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    BetaEncoder fit + mean transform of 鄉鎮市區
+    """
+    from .encoder import BetaEncoder
+    data = load_data(paths['targets'], usecols=['鄉鎮市區', '單價'])
+
+    def run() -> None:
+        encoder = BetaEncoder('鄉鎮市區')
+        encoder.fit(data, '單價')
+        encoder.transform(data, 'mean')
+    return run, len(data)
+
+
+def case_encode_cat_features(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    PreProc.encode_cat_features, the listings are also used as test / private
+    """
+    preproc, cols, x_data, y_data, test_x = encoded_frames(paths)
+    return lambda: preproc.encode_cat_features(
+        cols['cat_cols'], x_data.copy(), test_x.copy(), test_x.copy(), y_data
+    ), len(x_data)
+
+
+def case_stacking_fit(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    stacking().fit with the configs of configs/, the boosting rounds
+    capped at options['fit_rounds'] if set
+    """
+    preproc, cols, x_data, y_data, test_x = encoded_frames(paths)
+    x_tr, _, y_tr, _, _, _ = preproc.encode_cat_features(
+        cols['cat_cols'], x_data, test_x, test_x.copy(), y_data
+    )
+
+    def run() -> None:
+        capped_stacking(options).fit(x_tr, y_tr)
+    return run, len(x_tr)
+
+
+def capped_stacking(options: dict):
+    """
+    stacking() with the boosting rounds capped at options['fit_rounds'] if set
+    """
+    from .model.stacking import stacking
+    model = stacking()
+    if options.get('fit_rounds'):
+        for _, estimator in model.estimators:
+            estimator.set_params(**{ROUND_PARAMS[type(estimator).__name__]: options['fit_rounds']})
+    return model
+
+
+def fitted_predictor(paths: Dict[str, str], options: dict) -> tuple:
+    """
+    StackPredictor of a capped stacking fitted on at most
+    options['max_fit_rows'] listings, and the float32 matrix of all of them
+    """
+    from .inference import StackPredictor
+    preproc, cols, x_data, y_data, test_x = encoded_frames(paths)
+    x_tr, x_vl, y_tr, _, _, _ = preproc.encode_cat_features(
+        cols['cat_cols'], x_data, test_x, test_x.copy(), y_data
+    )
+    n_fit = options.get('max_fit_rows') or len(x_tr)
+    model = capped_stacking(options).fit(x_tr.iloc[:n_fit], y_tr.iloc[:n_fit])
+    x_all = pd.concat([x_tr, x_vl])[x_tr.columns].to_numpy(dtype=np.float32)
+    return StackPredictor.from_model(model, x_tr.columns), x_all
+
+
+def case_stack_predict_batch(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    StackPredictor.predict of every listing in one call (throughput)
+    """
+    predictor, x_all = fitted_predictor(paths, options)
+    return lambda: predictor.predict(x_all), len(x_all)
+
+
+def case_stack_predict_row(paths: Dict[str, str], options: dict) -> Tuple[Callable, int]:
+    """
+    StackPredictor.predict of 1000 listings one by one (latency)
+    """
+    predictor, x_all = fitted_predictor(paths, options)
+    rows = x_all[:1000]
+
+    def run() -> None:
+        for i in range(len(rows)):
+            predictor.predict(rows[i:i + 1])
+    return run, len(rows)
+
+
+CASES = {
+    'n_facilities': (case_n_facilities, True),
+    'mean_dist': (case_mean_dist, True),
+    'edu_nearest': (case_edu_nearest, True),
+    'edu_nearest_one': (case_edu_nearest_one, True),
+    'beta_encoder': (case_beta_encoder, False),
+    'encode_cat_features': (case_encode_cat_features, False),
+    'stacking_fit': (case_stacking_fit, False),
+    'stack_predict_batch': (case_stack_predict_batch, False),
+    'stack_predict_row': (case_stack_predict_row, False),
+}
+
+
+def run_case(name: str, paths: Dict[str, str], repeat: int, options: dict) -> dict:
+    """
+    Time a case, run inside its own process
+    """
+    run, rows = CASES[name][0](paths, options)
+    rss_before = peak_rss_mb()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    rss_after = peak_rss_mb()
+    return {
+        'rows': rows,
+        'seconds': min(seconds),
+        'rows_per_second': rows / min(seconds),
+        'peak_rss_mb': rss_after,
+        'rss_growth_mb': None if rss_after is None else rss_after - rss_before
+    }
+
+
+def run_benchmark(
+        cases: List[str],
+        targets: List[int],
+        facilities: List[int],
+        workdir: str,
+        repeat: int = 3,
+        max_fit_rows: int = 10000,
+        fit_rounds: int = 100
+    ) -> List[dict]:
+    """
+    Run every case at every scale
+    """
+    options = {'fit_rounds': fit_rounds, 'max_fit_rows': max_fit_rows}
+    results = []
+    for n_targets in targets:
+        for name in cases:
+            if name == 'stacking_fit' and n_targets > max_fit_rows:
+                continue
+            for n_facilities in facilities if CASES[name][1] else [None]:
+                paths = prepare(workdir, n_targets, n_facilities)
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                    result = pool.submit(run_case, name, paths, repeat, options).result()
+                result = {'case': name, 'targets': n_targets, 'facilities': n_facilities, **result}
+                print(
+                    f"{name:<20} targets={n_targets:<8} facilities={str(n_facilities):<6} "
+                    f"{result['seconds']:.3f}s {result['rows_per_second']:,.0f} rows/s",
+                    flush=True
+                )
+                results.append(result)
+    return results
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> pd.DataFrame:
+    """
+    Time and memory ratio of every case to the baseline, with the regressions flagged
+    """
+    keys = ['case', 'targets', 'facilities']
+    merged = pd.DataFrame(results).merge(
+        pd.DataFrame(baseline), on=keys, how='left', suffixes=('', '_baseline')
+    )
+    merged['time_ratio'] = merged['seconds'] / merged['seconds_baseline']
+    merged['rss_ratio'] = merged['rss_growth_mb'] / merged['rss_growth_mb_baseline']
+    merged['regression'] = (merged['time_ratio'] > 1 + tolerance) | (
+        (merged['rss_ratio'] > 1 + tolerance)
+        & (merged['rss_growth_mb'] - merged['rss_growth_mb_baseline'] > MIN_RSS_GROWTH_MB)
+    )
+    return merged[keys + ['seconds', 'seconds_baseline', 'time_ratio', 'rss_ratio', 'regression']]
+
+
+def parse_args() -> ArgumentParser:
+    """
+    parsing arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--targets", type=int, nargs="+", default=[10000, 100000, 1000000],
+        help="Numbers of target listings"
+    )
+    parser.add_argument(
+        "--facilities", type=int, nargs="+", default=[1000, 50000],
+        help="Numbers of facilities"
+    )
+    parser.add_argument(
+        "--cases", type=str, nargs="+", default=list(CASES), choices=list(CASES)
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="Runs per case, the fastest is kept"
+    )
+    parser.add_argument(
+        "--max_fit_rows", type=int, default=10000,
+        help="Largest number of targets for stacking_fit, listings fitted for the stack_predict cases"
+    )
+    parser.add_argument(
+        "--fit_rounds", type=int, default=100,
+        help="Boosting rounds of every base learner in stacking_fit, 0 for the full configs"
+    )
+    parser.add_argument(
+        "--workdir", type=str, default="data/benchmark",
+        help="Directory of the synthetic csv files"
+    )
+    parser.add_argument(
+        "--output", type=str, default="reports/benchmark.json",
+        help="Results of this run"
+    )
+    parser.add_argument(
+        "--baseline", type=str, default=None,
+        help="Results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="Allowed slowdown / memory growth before a case is flagged"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    ## read before the run, --output may be the baseline file being updated
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as json_file:
+            baseline = json.load(json_file)['results']
+
+    benchmark = run_benchmark(
+        args.cases, args.targets, args.facilities,
+        os.path.join(os.getcwd(), args.workdir), args.repeat, args.max_fit_rows, args.fit_rounds
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as json_file:
+        json.dump(
+            {
+                'created': datetime.now().isoformat(timespec="seconds"),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'cpu_count': os.cpu_count(),
+                'results': benchmark
+            },
+            json_file, indent=4
+        )
+
+    if baseline is not None:
+        report = compare(benchmark, baseline, args.tolerance)
+        print(report.to_string(index=False))
+        if report['regression'].any():
+            print(f"{int(report['regression'].sum())} regression(s) against {args.baseline}")
+            sys.exit(1)
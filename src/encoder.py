@@ -4,20 +4,49 @@ Beta Target Encoder
 Returns:
     _type_: _description_
 """
+import json
+from typing import Dict, List, Tuple, Union
 import numpy as np
 import pandas as pd
+from .utils.profiling import profiled
+
+STATS = {
+    "mean": lambda alpha, beta: alpha / (alpha + beta),
+    "mode": lambda alpha, beta: (alpha - 1) / (alpha + beta - 2),
+    "median": lambda alpha, beta: (alpha - 1/3) / (alpha + beta - 2/3),
+    "var": lambda alpha, beta: alpha * beta / ((alpha + beta) ** 2 * (alpha + beta + 1)),
+    "skewness": lambda alpha, beta: (
+        2 * (beta - alpha) * np.sqrt(alpha + beta + 1)
+    ) / (
+        (alpha + beta + 2) * np.sqrt(alpha * beta)
+    ),
+    "kurtosis": lambda alpha, beta: (
+        6*(alpha-beta)**2*(alpha+beta+1) - alpha*beta*(alpha+beta+2)
+    ) / (
+        alpha*beta*(alpha+beta+2)*(alpha+beta+3)
+    ),
+}
 
 
 class BetaEncoder:
     """
     Beta encoder for categorical features
+
+    fit builds one lookup slot per category (plus one for the unseen
+    ones), transform maps the rows to their slot by array indexing.
+    Non-negative integer codes (e.g. from LabelEncoder) are used as the
+    slots directly.
     """
     def __init__(self, group) -> None:
         self.group = group
-        self.stats = None
+        self.categories = None
+        self.sums = None
+        self.counts = None
         self.prior_mean = None
+        self.tables = {}
 
 
+    @profiled(rows="df")
     def fit(self, df: pd.DataFrame, target_col: str) -> None:
         """fitting the encoder
 
@@ -25,68 +54,294 @@ class BetaEncoder:
             df (pd.DataFrame)
             target_col (str)
         """
-        self.prior_mean = np.mean(df[target_col])
-        stats = df[[target_col, self.group]].groupby(self.group)
-        stats = stats.agg(['sum', 'count'])[target_col]
-        stats.reset_index(level=0, inplace=True)
-        self.stats = stats
+        target = df[target_col].to_numpy(dtype=np.float64)
+        values = df[self.group]
+        self.prior_mean = np.mean(target)
+
+        if pd.api.types.is_integer_dtype(values) and len(values) and values.min() >= 0:
+            self.categories = None
+            codes = values.to_numpy()
+            size = int(codes.max()) + 1
+        else:
+            codes, self.categories = pd.factorize(values)
+            target, codes = target[codes >= 0], codes[codes >= 0]
+            size = len(self.categories)
+
+        ## the last slot is for the unseen categories
+        self.sums = np.bincount(codes, weights=target, minlength=size + 1)
+        self.counts = np.bincount(codes, minlength=size + 1).astype(np.float64)
+        unseen = self.counts == 0
+        self.sums[unseen] = self.prior_mean
+        self.counts[unseen] = 1.0
+        self.tables = {}
+
+
+    @classmethod
+    def from_arrays(
+            cls, group, sums: np.ndarray, counts: np.ndarray, prior_mean: float, categories: list = None
+        ) -> "BetaEncoder":
+        """
+        Rebuild a fitted encoder from its lookup arrays
+        """
+        encoder = cls(group)
+        encoder.sums, encoder.counts = np.asarray(sums), np.asarray(counts)
+        encoder.prior_mean = prior_mean
+        encoder.categories = None if categories is None else pd.Index(categories)
+        return encoder
+
+
+    def codes(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        lookup slot of every row
+        """
+        unseen = len(self.counts) - 1
+        if self.categories is not None:
+            codes = self.categories.get_indexer(df[self.group])
+            codes[codes < 0] = unseen
+            return codes
+
+        values = pd.to_numeric(df[self.group], errors='coerce').to_numpy(dtype=np.float64)
+        known = (values >= 0) & (values < unseen)
+        codes = np.full(len(values), unseen, dtype=np.int64)
+        codes[known] = values[known].astype(np.int64)
+        return codes
+
+
+    @staticmethod
+    def stat_table(
+            sums: np.ndarray, counts: np.ndarray, prior_mean: float, stat_type: str, n_min: int
+        ) -> np.ndarray:
+        """
+        statistic of every slot from its sum and count
+        """
+        big_n_prior = np.maximum(n_min - counts, 0)
+        alpha = prior_mean * big_n_prior + sums
+        beta = (1 - prior_mean) * big_n_prior + counts - sums
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return STATS[stat_type](alpha, beta)
+
+
+    def table(self, stat_type: str, n_min: int = 10) -> np.ndarray:
+        """
+        lookup table of a statistic, computed once per fit
+        """
+        if (stat_type, n_min) not in self.tables:
+            self.tables[(stat_type, n_min)] = self.stat_table(
+                self.sums, self.counts, self.prior_mean, stat_type, n_min
+            )
+        return self.tables[(stat_type, n_min)]
 
 
+    @profiled(rows="df")
     def transform(
-            self, df: pd.DataFrame, stat_type: str, n_min: int = 10
-        ) -> pd.Series:
+            self, df: pd.DataFrame, stat_type: Union[str, List[str]], n_min: int = 10
+        ) -> Union[pd.Series, pd.DataFrame]:
         """
         transform the encoder
 
         Args:
             df (pd.DataFrame): _description_
-            stat_type (str): _description_
-            n_min (int, optional): _description_. Defaults to 1.
+            stat_type (str | List[str]): one statistic, or several at once
+            n_min (int, optional): _description_. Defaults to 10.
 
         Returns:
-            pd.Series: _description_
-        """
-        df_stats = pd.merge(df[[self.group]], self.stats, how='left')
-        n = df_stats['sum'].copy()
-        big_n = df_stats['count'].copy()
-        nan_indexs = np.isnan(n)
-        n[nan_indexs] = self.prior_mean
-        big_n[nan_indexs] = 1.0
-
-        big_n_prior = np.maximum(n_min - big_n, 0)
-        alpha_prior = self.prior_mean * big_n_prior
-        beta_prior  = (1 - self.prior_mean) * big_n_prior
-
-        alpha =  alpha_prior + n
-        beta =  beta_prior + big_n - n
-
-        stats_dict = {
-            "mean": {
-                'nom': alpha,
-                'denom': alpha + beta
-            },
-            "mode": {
-                'nom': alpha - 1,
-                'denom': alpha + beta - 2
-            },
-            "median": {
-                'nom': alpha - 1/3,
-                'denom': alpha + beta - 2/3
-            },
-            "var": {
-                'nom': alpha * beta,
-                'denom': (alpha + beta) ** 2 * (alpha + beta + 1)
-            },
-            "skewness": {
-                'nom': 2 * (beta - alpha) * np.sqrt(alpha + beta + 1),
-                'denom': (alpha + beta + 2) * np.sqrt(alpha * beta)
-            },
-            "kurtosis": {
-                'nom': 6*(alpha-beta)**2*(alpha+beta+1) - alpha*beta*(alpha+beta+2),
-                'denom': alpha*beta*(alpha+beta+2)*(alpha+beta+3)
-            }
-        }
+            pd.Series: _description_, a DataFrame (one column per stat) for several stats
+        """
+        codes = self.codes(df)
+        stat_types = [stat_type] if isinstance(stat_type, str) else stat_type
+        values = {}
+
+        for stat in stat_types:
+            value = self.table(stat, n_min)[codes]
+            value[np.isnan(value)] = np.nanmedian(value)
+            values[stat] = value
+
+        if isinstance(stat_type, str):
+            return pd.Series(values[stat_type], index=df.index)
+        return pd.DataFrame(values, index=df.index)
+
+
+    @profiled(rows="df")
+    def fit_transform_oof(
+            self,
+            df: pd.DataFrame,
+            target_col: str,
+            stat_type: Union[str, List[str]],
+            n_min: int = 10,
+            n_splits: int = 5,
+            random_state: int = 42
+        ) -> Union[pd.Series, pd.DataFrame]:
+        """
+        K-fold out-of-fold encoding of the training rows
+
+        Every row is encoded with the stats of the other folds, then the
+        encoder is left fitted on the whole df for the other splits.
+
+        Returns:
+            pd.Series: same as transform
+        """
+        from sklearn.model_selection import KFold
+        self.fit(df, target_col)
+        codes = self.codes(df)
+        target = df[target_col].to_numpy(dtype=np.float64)
+        size = len(self.counts)
+
+        folds = np.zeros(len(df), dtype=np.int64)
+        kfold = KFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+        for fold, (_, index) in enumerate(kfold.split(df)):
+            folds[index] = fold
+
+        ## per fold sums and counts in one bincount, the unseen slot stays empty
+        seen = codes < size - 1
+        slots = folds[seen] * size + codes[seen]
+        fold_sums = np.bincount(slots, weights=target[seen], minlength=n_splits * size)
+        fold_counts = np.bincount(slots, minlength=n_splits * size).astype(np.float64)
+        fold_sums = fold_sums.reshape(n_splits, size)
+        fold_counts = fold_counts.reshape(n_splits, size)
+        target_sums = np.bincount(folds, weights=target, minlength=n_splits)
+        target_counts = np.bincount(folds, minlength=n_splits)
+
+        stat_types = [stat_type] if isinstance(stat_type, str) else stat_type
+        values = {stat: np.empty(len(df)) for stat in stat_types}
+
+        for fold in range(n_splits):
+            rows = folds == fold
+            sums = fold_sums.sum(axis=0) - fold_sums[fold]
+            counts = fold_counts.sum(axis=0) - fold_counts[fold]
+            prior_mean = (target.sum() - target_sums[fold]) / (len(df) - target_counts[fold])
+            sums[counts == 0], counts[counts == 0] = prior_mean, 1.0
+            for stat in stat_types:
+                values[stat][rows] = self.stat_table(sums, counts, prior_mean, stat, n_min)[codes[rows]]
 
-        value = stats_dict[stat_type]['nom'] / stats_dict[stat_type]['denom']
-        value[np.isnan(value)] = np.nanmedian(value)
-        return value
+        for value in values.values():
+            value[np.isnan(value)] = np.nanmedian(value)
+
+        if isinstance(stat_type, str):
+            return pd.Series(values[stat_type], index=df.index)
+        return pd.DataFrame(values, index=df.index)
+
+
+    @classmethod
+    def fit_transform_many(
+            cls,
+            frames: List[pd.DataFrame],
+            cat_cols: List[str],
+            target_col: str,
+            stat_types: Tuple[str] = ("mean",),
+            n_min: int = 10,
+            oof_folds: int = None
+        ) -> Dict[str, "BetaEncoder"]:
+        """
+        Fit one encoder per column on frames[0] and add the <col>_<stat>
+        columns to every frame (in place)
+
+        With oof_folds, frames[0] is encoded out-of-fold and the other
+        frames with the stats of the whole frames[0].
+
+        Returns:
+            Dict[str, BetaEncoder]: fitted encoder of every column
+        """
+        encoders = {}
+
+        for col in cat_cols:
+            encoder = cls(col)
+            if oof_folds:
+                train_encoded = encoder.fit_transform_oof(
+                    frames[0], target_col, list(stat_types), n_min, oof_folds
+                )
+            else:
+                encoder.fit(frames[0], target_col)
+            encoders[col] = encoder
+            for i, frame in enumerate(frames):
+                if oof_folds and i == 0:
+                    encoded = train_encoded
+                else:
+                    encoded = encoder.transform(frame, list(stat_types), n_min)
+                for stat in stat_types:
+                    frame[f"{col}_{stat}"] = encoded[stat]
+        return encoders
+
+
+class CategoryVocab:
+    """
+    Shared label encoding vocabulary of all the categorical columns
+
+    The codes follow the sorted categories like LabelEncoder, unseen
+    categories get the reserved code len(categories), and the codes are
+    stored in the smallest signed int dtype that fits.
+    """
+    def __init__(self, cat_cols: List[str]) -> None:
+        self.cat_cols = cat_cols
+        self.vocabs = {}
+
+
+    def fit(self, *frames: pd.DataFrame) -> "CategoryVocab":
+        """
+        Build the vocabulary of every column from all the frames, in one
+        pass per column: a category column reuses its categories, the
+        others are factorized once, and the categories are unioned sorted
+        """
+        from pandas.api.types import union_categoricals
+        for col in self.cat_cols:
+            categoricals = [
+                pd.Categorical(frame[col]).remove_unused_categories() for frame in frames
+            ]
+            self.vocabs[col] = union_categoricals(categoricals, sort_categories=True).categories
+        return self
+
+
+    @staticmethod
+    def code_dtype(n_codes: int) -> type:
+        """
+        smallest signed int dtype for the codes, reserved code included
+        """
+        for dtype in (np.int8, np.int16, np.int32):
+            if n_codes < np.iinfo(dtype).max:
+                return dtype
+        return np.int64
+
+
+    def transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Codes of the categorical columns of df
+        """
+        encoded = {}
+
+        for col in self.cat_cols:
+            vocab = self.vocabs[col]
+            codes = vocab.get_indexer(df[col])
+            codes[codes < 0] = len(vocab)
+            encoded[col] = codes.astype(self.code_dtype(len(vocab)))
+        return pd.DataFrame(encoded, index=df.index)
+
+
+    def save(self, path: str) -> None:
+        """
+        Save the vocabularies as json, with their dtype so that non string
+        categories come back with the same codes
+        """
+        with open(path, 'w', encoding='utf-8') as json_file:
+            json.dump(
+                {
+                    col: {'dtype': str(vocab.dtype), 'values': vocab.tolist()}
+                    for col, vocab in self.vocabs.items()
+                },
+                json_file, ensure_ascii=False, indent=4, default=str
+            )
+
+
+    @classmethod
+    def load(cls, path: str) -> "CategoryVocab":
+        """
+        Load the vocabularies saved by save
+        """
+        with open(path, encoding='utf-8') as json_file:
+            vocabs = json.load(json_file)
+        vocab = cls(list(vocabs))
+        vocab.vocabs = {
+            ## a bare list is the format of the artifacts saved without dtypes
+            col: pd.Index(values) if isinstance(values, list)
+            else pd.Index(values['values'], dtype=values['dtype'])
+            for col, values in vocabs.items()
+        }
+        return vocab
@@ -9,14 +9,17 @@ Arguments:
 Example:
     python -m src.mean_dist --k 3
 """
-from typing import Tuple
+from typing import List, Tuple
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import NearestNeighbors
-from shapely.geometry import Point
 from ..utils.data_utils import (
     load_data,
-    add_coordinates
+    load_projected
+)
+from ..utils.profiling import profiled
+from ..utils.spatial_utils import (
+    build_tree,
+    query_nearest
 )
 
 
@@ -24,23 +27,33 @@ class MeanDist:
     """
     The class that can get the mean value of k nearest neighbors
     """
-    def __init__(self, facility_path: str, target_path: str, k: int, facility_name: str) -> None:
-        self.facility = load_data(facility_path)
+    def __init__(
+            self,
+            facility_path: str,
+            target_path: str,
+            k: int,
+            facility_name: str,
+            n_jobs: int = 1
+        ) -> None:
+        self.facility = load_projected(facility_path)
         self.target = load_data(target_path)
         self.facilities_with_dist, self.target_pos = self.split_data()
         self.facility_name = facility_name
         self.k = k
+        self.n_jobs = n_jobs
+        self.tree = None
 
 
     def split_data(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
         """
         Get the (x, y) for facility and target
         """
-        facility_pos = add_coordinates(self.facility, method="twd97")[['橫坐標', '縱坐標']]
+        facility_pos = self.facility[['橫坐標', '縱坐標']].dropna().reset_index(drop=True)
         target_pos = self.target[['橫坐標', '縱坐標']]
         return facility_pos, target_pos
 
 
+    @profiled(rows="target_pos")
     def get_avg_distances(
         self,
         facility_pos: pd.DataFrame,
@@ -50,51 +63,65 @@ class MeanDist:
         """
         get the k nearest neighbors for each buildings
         """
+        from sklearn.neighbors import NearestNeighbors
         facility_pos, target_pos = np.array(facility_pos), np.array(target_pos)
         nbrs = NearestNeighbors(
             n_neighbors=k,
+            n_jobs=self.n_jobs
         )
         nbrs.fit(facility_pos)
         distances, _ = nbrs.kneighbors(target_pos, n_neighbors=k)
         return distances
 
 
-    def calc_nn_mean_dist(self, x: int, y: int) -> float:
-        """
-        Get the mean value of point to k nearest neighbors
+    @profiled(rows="target_pos")
+    def calc_nn_dist_stats(self, target_pos: pd.DataFrame) -> pd.DataFrame:
         """
-        ref_point = Point(x, y)
+        Get the mean, min and k-th distance of the k nearest neighbors
+        for every target in one batched KD-tree query
 
-        self.facilities_with_dist['distance'] = self.facilities_with_dist.apply(
-            lambda row: ref_point.distance(
-                Point(row['橫坐標'], row['縱坐標'])
-            ),
-            axis = 1
+        Returns:
+            pd.DataFrame: columns mean, min, kth
+        """
+        if self.tree is None:
+            self.tree = build_tree(self.facilities_with_dist)
+        distances, _ = query_nearest(self.tree, target_pos, k=self.k, n_jobs=self.n_jobs)
+        return pd.DataFrame(
+            {
+                'mean': distances.mean(axis=1),
+                'min': distances[:, 0],
+                'kth': distances[:, -1]
+            },
+            index=target_pos.index if isinstance(target_pos, pd.DataFrame) else None
         )
 
-        self.facilities_with_dist = self.facilities_with_dist.sort_values(
-            by='distance',
-            ascending=True
-        )
 
-        mean = self.facilities_with_dist.iloc[0: self.k, 2].mean()
-        return mean
+    def calc_nn_mean_dist(self, x: int, y: int) -> float:
+        """
+        Get the mean value of point to k nearest neighbors
+        """
+        return self.calc_nn_dist_stats(np.array([[x, y]]))['mean'].iloc[0]
 
 
-    def update_dataframe(self, column_name: str="nn_mean_distance") -> pd.DataFrame:
+    def update_dataframe(
+            self,
+            column_name: str="nn_mean_distance",
+            stats: List[str] = None
+        ) -> pd.DataFrame:
         """
         Update the dataframe
-        """
-        self.target[column_name] = self.target_pos.apply(self.__mean_function, axis=1)
 
-        return self.target
+        The mean goes to column_name, other stats ("min", "kth") to
+        column_name_<stat>.
+        """
+        stats = ['mean'] if stats is None else stats
+        dist_stats = self.calc_nn_dist_stats(self.target_pos)
 
+        for stat in stats:
+            name = column_name if stat == 'mean' else f"{column_name}_{stat}"
+            self.target[name] = dist_stats[stat]
 
-    def __mean_function(self, row: pd.Series) -> float:
-        """
-        Private function for calculate mean
-        """
-        return self.calc_nn_mean_dist(row.iloc[0], row.iloc[1])
+        return self.target
 
 
     def main_knn(self) -> None:
@@ -2,8 +2,10 @@
 Merge library data with training data
 """
 import os
+from argparse import ArgumentParser
 import pandas as pd
 from .n_facilities_v2 import NFacilities
+from ..utils.feature_store import FeatureStore
 
 def merge(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
     """
@@ -13,14 +15,32 @@ def merge(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
     return df1
 
 
+def parse_args() -> ArgumentParser:
+    """
+    parsing arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Only count the IDs missing from the feature store"
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
     TARGET_PATH = f"{os.getcwd()}/data/training_data.csv"
     nfac = NFacilities(
         f"{os.getcwd()}/data/lib_xy.csv",
         TARGET_PATH,
         2000
     )
-    library_target = nfac.main()
+    if args.incremental:
+        library_target = FeatureStore().update(
+            "N_lib_2000", nfac.target, nfac.main, ['N_facilities']
+        )
+    else:
+        library_target = nfac.main()
     training_data = pd.read_csv(TARGET_PATH)
     training_data = merge(training_data, library_target)
     training_data.to_csv(f"{os.getcwd()}/data/training_data.csv", index = False)    
@@ -8,75 +8,78 @@ Argumemts:
 Example:
     python -m src.n_facilities_v2 --radius 500
 """
+from typing import List, Union
 import pandas as pd
-from tqdm import tqdm
-from shapely.geometry import Point
 from ..utils.data_utils import (
     load_data,
-    add_coordinates
+    load_projected
+)
+from ..utils.profiling import profiled
+from ..utils.spatial_utils import (
+    build_tree,
+    count_within_radius
 )
 
 
 class NFacilities:
     """
     Find the amount of facilities within the radius
+
+    rad can be a list of radius, e.g. [250, 500, 1000, 2000], then all of
+    them are counted in a single pass over the KD-tree.
     """
-    def __init__(self, facility_path: str, target_path: str, rad: int) -> None:
-        self.facility = load_data(facility_path)
+    def __init__(
+            self,
+            facility_path: str,
+            target_path: str,
+            rad: Union[int, List[int]],
+            n_jobs: int = 1
+        ) -> None:
+        self.facility = load_projected(facility_path)
         self.target = load_data(target_path)
         self.rad = rad
+        self.n_jobs = n_jobs
 
 
     def split_data(self) -> tuple:
         """
         Get the (x, y) for facility and target
         """
-        facility_pos = add_coordinates(self.facility, method="twd97")[['橫坐標', '縱坐標']]
+        ## cKDTree needs finite points, facilities without coordinates are dropped
+        facility_pos = self.facility[['橫坐標', '縱坐標']].dropna()
         target_pos = self.target[['橫坐標', '縱坐標']]
         return facility_pos, target_pos
 
 
-    def calculate_dist(self, facility_pos: pd.DataFrame, target_pos: pd.DataFrame, num: int) -> pd.DataFrame:
+    @profiled(rows="target_pos")
+    def find_n_facilities(self, facility_pos: pd.DataFrame, target_pos: pd.DataFrame) -> pd.DataFrame:
         """
-        Get the distance between each facility and the target
-        -----------------------------------------------------
-        Example
-            ref_point: POINT(305266, 2768378)
+        Find the amount of facilities within the radius for every target
+
+        Returns:
+            pd.DataFrame: one column per radius, N_facilities_<radius>
         """
-        ref_point = Point(
-            target_pos.iloc[num, 0],
-            target_pos.iloc[num, 1]
+        radii = self.rad if isinstance(self.rad, (list, tuple)) else [self.rad]
+        counts = count_within_radius(
+            build_tree(facility_pos), target_pos, radii, n_jobs=self.n_jobs
         )
-        facility_pos['distance'] = facility_pos.apply(
-            lambda row: ref_point.distance(
-                Point(row['橫坐標'], row['縱坐標'])
-            ),
-            axis = 1
+        return pd.DataFrame(
+            counts,
+            columns=[f'N_facilities_{rad}' for rad in radii],
+            index=target_pos.index
         )
-        return facility_pos
-
-
-    def find_n_facilities(self, facility_pos: pd.DataFrame) -> int:
-        """
-        Find the amount of facilities within the radius
-        """
-        facility_pos = facility_pos[facility_pos['distance'] <= self.rad]
-        return len(facility_pos)
 
 
-    def main(self) -> pd.DataFrame:
+    def main(self, target: pd.DataFrame = None) -> pd.DataFrame:
         """
-        Main function
+        Main function, for all the targets or only the given rows of them
         """
-        target_calculated = self.target.copy()
-        target_calculated['N_facilities'] = 0
-        target_calculated['N_facilities'] = target_calculated['N_facilities'].astype(int)
-        facility_pos, target_pos = self.split_data()
+        target = self.target if target is None else target
+        facility_pos, _ = self.split_data()
+        n_facilities = self.find_n_facilities(facility_pos, target[['橫坐標', '縱坐標']])
 
-        for i in tqdm(range(len(target_pos))):
-            facility_pos = self.calculate_dist(facility_pos, target_pos, i)
-            n_facilities = self.find_n_facilities(facility_pos)
-            target_calculated.loc[i, 'N_facilities'] = n_facilities
+        if not isinstance(self.rad, (list, tuple)):
+            n_facilities.columns = ['N_facilities']
 
-        target_calculated = target_calculated[['ID', 'N_facilities']]
+        target_calculated = pd.concat([target[['ID']], n_facilities], axis=1)
         return target_calculated
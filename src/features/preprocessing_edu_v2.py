@@ -2,16 +2,25 @@
 File for preprocessing educational institution data
 """
 import os
+from argparse import ArgumentParser
+from typing import Tuple
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from shapely.geometry import Point
 from ..utils.data_utils import (
     load_data,
+    load_projected,
     add_coordinates
 )
+from ..utils.feature_store import FeatureStore
+from ..utils.profiling import profiled
+from ..utils.spatial_utils import (
+    build_tree,
+    query_nearest
+)
 
 PATH = f'{os.getcwd()}/data/external_data'
 PATH_traindata = f'{os.getcwd()}/data/training_data.csv'
+EDU_COLS = ['鄰近熱門國小', '鄰近熱門國中', '鄰近完全中學']
 
 
 class PreprocessingEdu:
@@ -24,10 +33,9 @@ class PreprocessingEdu:
         General preprocessing for educational data
         """
         data_path = os.path.join(PATH, file_name)
-        data = load_data(data_path)
         if add_coor:
-            data = add_coordinates(data, "twd97")
-        return data
+            return load_projected(data_path)
+        return load_data(data_path)
 
 
     def preprocess_univ(self) -> pd.DataFrame:
@@ -111,68 +119,80 @@ class PreprocessingEdu:
 
     def merge_es_info(self, training_data:pd.DataFrame, es_data:pd.DataFrame):
         """
-        pass
+        Add whether the nearest elementary school is popular
         """
-        column_names = training_data.columns
-
-        for row in tqdm(training_data.itertuples()):
-            unit_x = row[column_names.get_loc('橫坐標') + 1]
-            unit_y = row[column_names.get_loc('縱坐標') + 1]
-
-            nearest_index = self.find_nearest_facility(unit_x, unit_y, es_data)
-            training_data['鄰近熱門國小'] = es_data['Is_Popular'].iloc[nearest_index]
+        nearest_index, _ = self.find_nearest_facilities(
+            training_data[['橫坐標', '縱坐標']].to_numpy(), es_data
+        )
+        training_data['鄰近熱門國小'] = es_data['Is_Popular'].to_numpy()[nearest_index]
         return training_data
 
 
     def merge_jhs_info(self, training_data:pd.DataFrame, jhs_data:pd.DataFrame):
         """
-        pass
+        Add whether the nearest junior high school is popular / combined
         """
-        column_names = training_data.columns
+        nearest_index, _ = self.find_nearest_facilities(
+            training_data[['橫坐標', '縱坐標']].to_numpy(), jhs_data
+        )
+        training_data['鄰近熱門國中'] = jhs_data['Is_Popular'].to_numpy()[nearest_index]
+        training_data['鄰近完全中學'] = jhs_data['Is_Combined'].to_numpy()[nearest_index]
 
-        for row in tqdm(training_data.itertuples()):
-            unit_x = row[column_names.get_loc('橫坐標') + 1]
-            unit_y = row[column_names.get_loc('縱坐標') + 1]
+        return training_data
 
-            nearest_index = self.find_nearest_facility(unit_x, unit_y, jhs_data)
-            training_data['鄰近熱門國中'] = jhs_data['Is_Popular'].iloc[nearest_index]
-            training_data['鄰近完全中學'] = jhs_data['Is_Combined'].iloc[nearest_index]
 
-        return training_data
+    @profiled(rows="units")
+    def find_nearest_facilities(
+            self, units: np.ndarray, facilities: pd.DataFrame
+        ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the position and distance of the nearest facility for every unit
+
+        Args:
+            units (np.ndarray): (n, 2) array of 橫坐標, 縱坐標
+            facilities (pd.DataFrame): facilities with 橫坐標, 縱坐標
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: nearest positions in facilities and distances
+        """
+        distances, indices = query_nearest(build_tree(facilities), units, k=1)
+        return indices[:, 0], distances[:, 0]
 
 
     def find_nearest_facility(self, unit_x: float, unit_y: float, facilities_with_dist) -> float:
         """
         Get the index of the nearest neighbor
         """
-        ref_point = Point(unit_x, unit_y)
-
-        facilities_with_dist['distance'] = facilities_with_dist.apply(
-            lambda row: ref_point.distance(
-                Point(row['橫坐標'], row['縱坐標'])
-            ),
-            axis = 1
+        nearest_index, _ = self.find_nearest_facilities(
+            np.array([[unit_x, unit_y]]), facilities_with_dist
         )
+        return facilities_with_dist.index[nearest_index[0]]
 
-        facilities_with_dist = facilities_with_dist.sort_values(
-            by = 'distance',
-            ascending=True
-        )
 
-        nearest_index = facilities_with_dist.head(1).index.tolist()[0]
-        return nearest_index
+    @profiled(rows="target")
+    def edu_features(self, target: pd.DataFrame) -> pd.DataFrame:
+        """
+        ID + educational features of the target rows
+        """
+        edu = target[['ID', '橫坐標', '縱坐標']].copy()
+        edu = self.merge_es_info(edu, self.preprocessing_es())
+        edu = self.merge_jhs_info(edu, self.preprocessing_jhs())
+        return edu[['ID'] + EDU_COLS]
 
 
-    def create_edu_feature(self) -> None:
+    def create_edu_feature(self, incremental: bool = False) -> None:
         """
         create educational features
+
+        incremental: only compute the IDs missing from the feature store
         """
-        trainingdata = load_data(PATH_traindata)
-        es_processing_data = self.preprocessing_es()
-        jhs_processing_data = self.preprocessing_jhs()
+        training_edited = load_data(PATH_traindata)
 
-        training_edited = self.merge_es_info(trainingdata, es_processing_data)
-        training_edited = self.merge_jhs_info(trainingdata, jhs_processing_data)
+        if incremental:
+            edu = FeatureStore().update("edu", training_edited, self.edu_features, EDU_COLS)
+        else:
+            edu = self.edu_features(training_edited)
+        training_edited[EDU_COLS] = edu[EDU_COLS]
 
         column_to_move = training_edited['單價']
         training_edited = training_edited.drop('單價', axis=1)
@@ -183,5 +203,10 @@ class PreprocessingEdu:
         training_edited.to_csv('training_data_edited.csv', index=False)
 
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Only compute the IDs missing from the feature store"
+    )
     edu_preproc = PreprocessingEdu()
-    edu_preproc.create_edu_feature()
+    edu_preproc.create_edu_feature(parser.parse_args().incremental)
@@ -0,0 +1,230 @@
+"""
+Road network distance to the facilities
+
+Author: Yu-Chen, Den
+-----------------------------------
+The road graph is read from two local tables (e.g. an OSM extract exported
+to csv / parquet):
+    nodes: node, 橫坐標, 縱坐標 (or lat, lng)
+    edges: u, v[, length]   (length in metres, euclidean if missing)
+
+Listings and facilities are snapped to their nearest node with a KD-tree.
+For every facility table, the road distances from every node to its k
+nearest facilities are computed once with a single multi-source Dijkstra
+and cached as .npy, so scoring new listings is a snap + a table lookup,
+never a graph search.
+"""
+import os
+import heapq
+import hashlib
+from typing import Union
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from ..utils.data_utils import (
+    CACHE_DIR,
+    load_data,
+    add_coordinates,
+    file_hash
+)
+from ..utils.spatial_utils import (
+    to_xy,
+    build_tree,
+    query_nearest
+)
+
+## csgraph drops zero weights, so zero length edges get this length (metres)
+MIN_LENGTH = 1e-3
+## part of the table cache key, bumped when the content of the tables changes
+TABLE_VERSION = 2
+
+
+class RoadNetwork:
+    """
+    Road graph with node snapping and cached per-node facility distances
+    """
+    def __init__(
+            self,
+            nodes_path: str,
+            edges_path: str,
+            limit: float = np.inf,
+            cache_dir: str = CACHE_DIR
+        ) -> None:
+        nodes = load_data(nodes_path)
+        if '橫坐標' not in nodes.columns:
+            nodes = add_coordinates(nodes, method="twd97")
+        edges = load_data(edges_path)
+
+        self.node_ids = pd.Index(nodes['node'])
+        self.node_pos = to_xy(nodes)
+        self.tree = build_tree(self.node_pos)
+        self.graph = self.build_graph(edges)
+        self.limit = limit
+        self.cache_dir = cache_dir
+        self.key = f"{file_hash(nodes_path)}_{file_hash(edges_path)}"
+        self.tables = {}
+
+
+    def build_graph(self, edges: pd.DataFrame) -> csr_matrix:
+        """
+        Symmetric sparse adjacency matrix, the shortest of parallel edges is kept
+        """
+        u = self.node_ids.get_indexer(edges['u'])
+        v = self.node_ids.get_indexer(edges['v'])
+        if 'length' in edges.columns:
+            length = edges['length'].to_numpy(dtype=np.float64)
+        else:
+            length = np.hypot(*(self.node_pos[u] - self.node_pos[v]).T)
+
+        known = (u >= 0) & (v >= 0) & (u != v)
+        if not known.all():
+            print(f"{int((~known).sum())} edges with unknown nodes or loops dropped")
+        links = pd.DataFrame({
+            'u': np.concatenate([u[known], v[known]]),
+            'v': np.concatenate([v[known], u[known]]),
+            'length': np.maximum(np.tile(length[known], 2), MIN_LENGTH)
+        }).sort_values('length').drop_duplicates(['u', 'v'])
+
+        n_nodes = len(self.node_ids)
+        return csr_matrix(
+            (links['length'].to_numpy(), (links['u'].to_numpy(), links['v'].to_numpy())),
+            shape=(n_nodes, n_nodes)
+        )
+
+
+    def snap(self, pos: Union[pd.DataFrame, np.ndarray]) -> tuple:
+        """
+        Nearest node and the distance to it of every position
+        """
+        distances, indices = query_nearest(self.tree, to_xy(pos), k=1)
+        return indices[:, 0], distances[:, 0]
+
+
+    def nearest_one(self, nodes: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        Road distance of every node to its nearest facility, one Dijkstra
+        from a virtual source linked to every facility node by its snap distance
+        """
+        n_nodes = self.graph.shape[0]
+        offsets = pd.Series(offsets).groupby(nodes).min()
+        graph = self.graph.tocoo()
+        graph = csr_matrix(
+            (
+                np.concatenate([graph.data, np.maximum(offsets.to_numpy(), MIN_LENGTH)]),
+                (
+                    np.concatenate([graph.row, np.full(len(offsets), n_nodes)]),
+                    np.concatenate([graph.col, offsets.index.to_numpy()])
+                )
+            ),
+            shape=(n_nodes + 1, n_nodes + 1)
+        )
+        distances = dijkstra(graph, directed=True, indices=n_nodes, limit=self.limit)
+        return distances[:n_nodes, None]
+
+
+    def nearest_k(self, nodes: np.ndarray, offsets: np.ndarray, k: int) -> np.ndarray:
+        """
+        Road distances of every node to its k nearest facilities, in one
+        multi-source Dijkstra where every node keeps up to k labels from
+        distinct facilities. Like nearest_one, the limit bounds the graph
+        distance + the facility snap distance
+        """
+        n_nodes = self.graph.shape[0]
+        indptr = self.graph.indptr.tolist()
+        neighbors = self.graph.indices.tolist()
+        lengths = self.graph.data.tolist()
+        limit = self.limit
+        ## facilities settled at every node, in the order of their distance
+        sources = [None] * n_nodes
+        labels = [None] * n_nodes
+
+        heap = [
+            (offset, node, facility)
+            for facility, (node, offset) in enumerate(zip(nodes.tolist(), offsets.tolist()))
+            if offset <= limit
+        ]
+        heapq.heapify(heap)
+        while heap:
+            dist, node, facility = heapq.heappop(heap)
+            settled = sources[node]
+            if settled is None:
+                settled = sources[node] = []
+                labels[node] = []
+            elif len(settled) == k or facility in settled:
+                continue
+            settled.append(facility)
+            labels[node].append(dist)
+
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbor, next_dist = neighbors[i], dist + lengths[i]
+                if next_dist > limit:
+                    continue
+                reached = sources[neighbor]
+                if reached is not None and (len(reached) == k or facility in reached):
+                    continue
+                heapq.heappush(heap, (next_dist, neighbor, facility))
+
+        table = np.full((n_nodes, k), np.inf)
+        for node, dists in enumerate(labels):
+            if dists:
+                table[node, :len(dists)] = dists
+        return table
+
+
+    def facility_distances(self, facility_pos: Union[pd.DataFrame, np.ndarray], k: int = 3) -> np.ndarray:
+        """
+        (n_nodes, k) road distances of every node to its k nearest
+        facilities, inf past the limit, cached on disk by graph, facilities, k and limit
+        """
+        facility_xy = to_xy(facility_pos)
+        sha = hashlib.sha256(f"{self.key}_{k}_{self.limit}_{TABLE_VERSION}".encode("utf-8"))
+        sha.update(facility_xy.tobytes())
+        key = sha.hexdigest()[:16]
+
+        if key not in self.tables:
+            cache_path = os.path.join(self.cache_dir, f"road_{key}.npy")
+            if os.path.exists(cache_path):
+                self.tables[key] = np.load(cache_path)
+            else:
+                nodes, offsets = self.snap(facility_xy)
+                if k == 1:
+                    table = self.nearest_one(nodes, offsets)
+                else:
+                    table = self.nearest_k(nodes, offsets, min(k, len(nodes)))
+                os.makedirs(self.cache_dir, exist_ok=True)
+                np.save(cache_path, table)
+                self.tables[key] = table
+        return self.tables[key]
+
+
+    def distances(
+            self,
+            target_pos: Union[pd.DataFrame, np.ndarray],
+            facility_pos: Union[pd.DataFrame, np.ndarray],
+            k: int = 3
+        ) -> np.ndarray:
+        """
+        (n, k) road distances of every target to its k nearest facilities,
+        snap distances included, inf if not reachable within the limit
+        """
+        nodes, offsets = self.snap(target_pos)
+        distances = self.facility_distances(facility_pos, k)[nodes] + offsets[:, None]
+        distances[distances > self.limit] = np.inf
+        return distances
+
+
+    def mean_distance(
+            self,
+            target_pos: Union[pd.DataFrame, np.ndarray],
+            facility_pos: Union[pd.DataFrame, np.ndarray],
+            k: int = 3
+        ) -> np.ndarray:
+        """
+        Mean road distance to the reachable ones of the k nearest
+        facilities, NaN if none is reachable
+        """
+        distances = self.distances(target_pos, facility_pos, k)
+        reachable = np.isfinite(distances)
+        with np.errstate(invalid="ignore"):
+            return np.where(reachable, distances, 0).sum(axis=1) / reachable.sum(axis=1)
@@ -1,22 +1,103 @@
 """
 social economic feature
 """
-import geopandas as gpd
+import os
+import hashlib
+from typing import List
+import numpy as np
 import pandas as pd
+import shapely
+from ..utils.data_utils import (
+    CACHE_DIR,
+    file_hash
+)
 
-def add_social_economic_feature(house: pd.DataFrame) -> pd.DataFrame:
+VILLAGE_PATH = f"{os.getcwd()}/data/new_data/social_economic_data/social_economic_feature.shp"
+VILLAGE_COLS = ["avg_tax", "density", "edu_p"]
+
+
+class VillageIndex:
+    """
+    STRtree over the village polygons with their social economic attributes
+
+    The polygons are read from the shapefile once and cached as WKB next to
+    their attributes, keyed by the hash of the .shp and .dbf, so the next
+    loads skip geopandas entirely.
+    """
+    def __init__(self, geometries: np.ndarray, attrs: pd.DataFrame) -> None:
+        self.geometries = geometries
+        self.attrs = attrs.reset_index(drop=True)
+        self.tree = shapely.STRtree(geometries)
+
+
+    @classmethod
+    def load(cls, path: str = VILLAGE_PATH, cache_dir: str = CACHE_DIR) -> "VillageIndex":
+        """
+        Index of a village shapefile, read through the cache
+        """
+        base, _ = os.path.splitext(path)
+        sha = hashlib.sha256()
+        for ext in (".shp", ".dbf"):
+            sha.update(file_hash(f"{base}{ext}").encode("utf-8"))
+        cache_path = os.path.join(
+            cache_dir, f"{os.path.basename(base)}_{sha.hexdigest()[:16]}.pkl"
+        )
+
+        if os.path.exists(cache_path):
+            villages = pd.read_pickle(cache_path)
+        else:
+            import geopandas as gpd
+            village_feature = gpd.read_file(path)
+            if village_feature.crs is not None and village_feature.crs.to_epsg() != 3826:
+                village_feature = village_feature.to_crs(epsg=3826)
+            villages = pd.DataFrame(village_feature.drop(columns="geometry"))
+            villages["wkb"] = shapely.to_wkb(village_feature.geometry.to_numpy())
+            os.makedirs(cache_dir, exist_ok=True)
+            villages.to_pickle(cache_path)
+        return cls(shapely.from_wkb(villages["wkb"].to_numpy()), villages.drop(columns="wkb"))
+
+
+    def lookup(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Village position of every point, the nearest village for the points
+        outside every polygon, -1 for the points without coordinates
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        points = shapely.points(x, y)
+        point_idx, village_idx = self.tree.query(points, predicate="intersects")
+        villages = np.full(len(points), -1, dtype=np.int64)
+
+        ## sjoin repeats a point on a shared border once per village, here it
+        ## keeps one row and takes the village of the lowest index
+        order = np.lexsort((village_idx, point_idx))
+        point_idx, village_idx = point_idx[order], village_idx[order]
+        first = np.unique(point_idx, return_index=True)[1]
+        villages[point_idx[first]] = village_idx[first]
+
+        outside = np.flatnonzero((villages < 0) & ~np.isnan(x) & ~np.isnan(y))
+        if len(outside) > 0:
+            point_idx, village_idx = self.tree.query_nearest(points[outside], all_matches=False)
+            villages[outside[point_idx]] = village_idx
+        return villages
+
+
+    def features(self, x: np.ndarray, y: np.ndarray, columns: List[str] = None) -> pd.DataFrame:
+        """
+        Village attributes of every point, NaN for the points without coordinates
+        """
+        columns = VILLAGE_COLS if columns is None else columns
+        return self.attrs[columns].reindex(self.lookup(x, y)).reset_index(drop=True)
+
+
+def add_social_economic_feature(house: pd.DataFrame, index: VillageIndex = None) -> pd.DataFrame:
     """
     This is a function to add 3 social economic village features into training/testing data.
     "social_economic_feature.shp" contains 3 features "avg_tax", "density", "edu_p".
     Note: house should contain "橫坐標" & "縱坐標".
+    Pass index to reuse a VillageIndex which is already loaded.
     """
-    village_feature = gpd.read_file(
-        "../data/new_data/social_economic_data/social_economic_feature.shp"
-    )
-    house_gdf = gpd.GeoDataFrame(
-        house, geometry=gpd.points_from_xy(house["橫坐標"], house["縱坐標"]), crs="EPSG:3826"
-    )
-    house_gdf = gpd.sjoin(
-        house_gdf, village_feature, how="left"
-    )
-    return pd.DataFrame(house_gdf.drop(columns=["V_ID", "geometry", "index_right"]))
+    index = VillageIndex.load() if index is None else index
+    columns = [col for col in index.attrs.columns if col != "V_ID"]
+    features = index.features(house["橫坐標"], house["縱坐標"], columns)
+    features.index = house.index
+    return pd.concat([house, features], axis=1)
@@ -0,0 +1,297 @@
+"""
+Single pass builder for all the facility based spatial features
+
+Author: Yu-Chen, Den
+-----------------------------------
+The target coordinates are loaded once, every facility table is read and
+projected once and indexed by one KD-tree, then all the requested
+avg_distances_<name>, N_<name>_<radius> and nearest attribute columns
+are computed from it. With a RoadNetwork, road_distances_<name> (mean
+road distance to the k nearest facilities) can be requested too.
+
+Example:
+    python -m src.features.spatial_builder --target data/public_dataset.csv
+"""
+import os
+import re
+import json
+from argparse import ArgumentParser
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from ..utils.data_utils import (
+    load_data,
+    load_projected,
+    file_hash
+)
+from ..utils.feature_store import FeatureStore
+from ..utils.profiling import profiled
+from .road_network import RoadNetwork
+from ..utils.spatial_utils import (
+    to_xy,
+    build_tree,
+    count_within_radius,
+    query_nearest
+)
+
+PATH = f'{os.getcwd()}/data'
+
+FACILITIES = {
+    '高中': 'external_data/高中基本資料.csv',
+    '國中': 'external_data/國中基本資料_v2.csv',
+    '國小': 'external_data/國小基本資料_v2.csv',
+    '大學': 'external_data/大學基本資料.csv',
+    '火車': 'external_data/火車站點資料.csv',
+    '捷運': 'external_data/捷運站點資料.csv',
+    '便利': 'external_data/便利商店.csv',
+    'AT': 'external_data/ATM資料.csv',
+    '金融': 'external_data/金融機構基本資料.csv',
+    '郵局': 'external_data/郵局據點資料.csv',
+    'lib': 'lib_xy.csv',
+}
+
+NEAREST_ATTRS = {
+    '鄰近熱門國小': ('國小', 'Is_Popular'),
+    '鄰近熱門國中': ('國中', 'Is_Popular'),
+    '鄰近完全中學': ('國中', 'Is_Combined'),
+}
+
+AVG_PATTERN = re.compile(r'^avg_distances_(.+)$')
+ROAD_PATTERN = re.compile(r'^road_distances_(.+)$')
+COUNT_PATTERN = re.compile(r'^N_(.+)_(\d+)$')
+
+
+class SpatialFeatureBuilder:
+    """
+    Build every spatial feature of the targets in one pass
+    """
+    def __init__(
+            self,
+            target_path: str,
+            facilities: Dict[str, str] = None,
+            k: int = 3,
+            n_jobs: int = 1,
+            road_network: RoadNetwork = None
+        ) -> None:
+        self.target = load_data(target_path) if target_path else None
+        self.target_pos = to_xy(self.target) if target_path else None
+        self.facilities = FACILITIES if facilities is None else facilities
+        self.k = k
+        self.n_jobs = n_jobs
+        self.road_network = road_network
+        self.facility_data = {}
+        self.trees = {}
+        self.skipped = set()
+
+
+    def get_facility(self, name: str) -> pd.DataFrame:
+        """
+        Load and project a facility table, only once per facility type
+        """
+        if name not in self.facility_data:
+            data = load_projected(os.path.join(PATH, self.facilities[name]))
+            data = data.dropna(subset=['橫坐標', '縱坐標']).reset_index(drop=True)
+            self.facility_data[name] = data
+            self.trees[name] = build_tree(data)
+        return self.facility_data[name]
+
+
+    def plan(self, columns: List[str]) -> Dict[str, dict]:
+        """
+        Group the requested columns by facility type
+
+        Returns:
+            Dict[str, dict]: {name: {'avg': column, 'road': column,
+                'radius': {column: radius}, 'attrs': {column: attr}}}
+        """
+        tasks = {}
+
+        for col in columns:
+            avg_match, count_match = AVG_PATTERN.match(col), COUNT_PATTERN.match(col)
+            road_match = ROAD_PATTERN.match(col)
+            if avg_match:
+                name, key, value = avg_match.group(1), 'avg', col
+            elif road_match:
+                name, key, value = road_match.group(1), 'road', col
+            elif count_match:
+                name, key, value = count_match.group(1), 'radius', int(count_match.group(2))
+            elif col in NEAREST_ATTRS:
+                name, key, value = NEAREST_ATTRS[col][0], 'attrs', NEAREST_ATTRS[col][1]
+            else:
+                continue
+
+            if name not in self.facilities or (key == 'road' and self.road_network is None):
+                if col not in self.skipped:
+                    print(f"No facility data or road network for {col}, skipped")
+                    self.skipped.add(col)
+                continue
+
+            task = tasks.setdefault(name, {'avg': None, 'road': None, 'radius': {}, 'attrs': {}})
+            if key in ('avg', 'road'):
+                task[key] = value
+            else:
+                task[key][col] = value
+        return tasks
+
+
+    def config(self, columns: List[str]) -> dict:
+        """
+        Everything the values of the columns depend on besides the target
+        rows: k, radii, facility files and road graph
+        """
+        tasks = self.plan(columns)
+        config = {
+            'k': self.k,
+            'radius': {col: rad for task in tasks.values() for col, rad in task['radius'].items()},
+            'facilities': {
+                name: file_hash(os.path.join(PATH, self.facilities[name])) for name in sorted(tasks)
+            }
+        }
+        if any(task['road'] for task in tasks.values()):
+            config['road'] = {'graph': self.road_network.key, 'limit': self.road_network.limit}
+        return config
+
+
+    def build_facility(self, name: str, task: dict, target_pos: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Compute all the columns of a single facility type
+        """
+        facility = self.get_facility(name)
+        tree = self.trees[name]
+        features = {}
+
+        if task['avg'] is not None or task['attrs']:
+            distances, indices = query_nearest(
+                tree, target_pos, k=self.k, n_jobs=self.n_jobs
+            )
+            if task['avg'] is not None:
+                features[task['avg']] = distances.mean(axis=1)
+            for col, attr in task['attrs'].items():
+                if tree.n == 0:
+                    features[col] = np.full(len(indices), np.nan)
+                else:
+                    features[col] = facility[attr].to_numpy()[indices[:, 0]]
+
+        if task['road'] is not None:
+            features[task['road']] = self.road_network.mean_distance(
+                target_pos, facility, k=self.k
+            )
+
+        if task['radius']:
+            counts = count_within_radius(
+                tree, target_pos, list(task['radius'].values()), n_jobs=self.n_jobs
+            )
+            for i, col in enumerate(task['radius']):
+                features[col] = counts[:, i]
+        return features
+
+
+    @profiled(rows="target")
+    def build(self, columns: List[str], target: pd.DataFrame = None) -> pd.DataFrame:
+        """
+        Build the requested spatial columns for every target,
+        or only for the given rows of the target
+
+        Returns:
+            pd.DataFrame: ID + spatial columns, in the order of columns
+        """
+        target = self.target if target is None else target
+        target_pos = self.target_pos if target is self.target else to_xy(target)
+        features = {}
+
+        for name, task in self.plan(columns).items():
+            features.update(self.build_facility(name, task, target_pos))
+
+        built = pd.DataFrame(features, index=target.index)
+        built = built[[col for col in columns if col in features]]
+        return pd.concat([target[['ID']], built], axis=1)
+
+
+    def main(self, columns: List[str], store: FeatureStore = None, group: str = "spatial") -> pd.DataFrame:
+        """
+        Main function, update the target with the spatial columns
+
+        With a feature store, only the IDs missing from the group are built
+        and appended to it.
+        """
+        if store is None:
+            built = self.build(columns)
+        else:
+            planned = {
+                col for task in self.plan(columns).values()
+                for col in [task['avg'], task['road'], *task['radius'], *task['attrs']]
+            }
+            columns = [col for col in columns if col in planned]
+            built = store.update(
+                group, self.target, lambda new: self.build(columns, new), columns,
+                config=self.config(columns)
+            )
+        built = built.drop(columns=['ID'])
+        self.target[built.columns] = built
+        return self.target
+
+
+def parse_args() -> ArgumentParser:
+    """
+    parsing arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--target", type=str, default="data/training_data.csv",
+        help="Target csv with 橫坐標 and 縱坐標"
+    )
+    parser.add_argument(
+        "--output", type=str, default=None,
+        help="Output csv, default overwrite the target"
+    )
+    parser.add_argument(
+        "--k", type=int, default=3,
+        help="Number of nearest neighbors"
+    )
+    parser.add_argument(
+        "--n_jobs", type=int, default=1,
+        help="Workers for the KD-tree queries, -1 for all cores"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Only build the IDs missing from the feature store"
+    )
+    parser.add_argument(
+        "--road_nodes", type=str, default=None,
+        help="Road graph nodes (node, 橫坐標, 縱坐標 or lat, lng), adds road_distances_<name>"
+    )
+    parser.add_argument(
+        "--road_edges", type=str, default=None,
+        help="Road graph edges (u, v[, length])"
+    )
+    parser.add_argument(
+        "--road_limit", type=float, default=np.inf,
+        help="Road distance (metres, snap distances included) past which a facility counts as unreachable"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with open(f"{os.getcwd()}/columns.json", encoding="utf-8") as json_file:
+        cols = json.load(json_file)
+
+    columns = cols['feat_cols'] + list(NEAREST_ATTRS)
+    if (args.road_nodes is None) != (args.road_edges is None):
+        raise ValueError("--road_nodes and --road_edges must be given together")
+    road_network = None
+    if args.road_nodes:
+        road_network = RoadNetwork(
+            f"{os.getcwd()}/{args.road_nodes}", f"{os.getcwd()}/{args.road_edges}", args.road_limit
+        )
+        columns += [f"road_distances_{name}" for name in FACILITIES]
+
+    builder = SpatialFeatureBuilder(
+        f"{os.getcwd()}/{args.target}", k=args.k, n_jobs=args.n_jobs, road_network=road_network
+    )
+    builder.main(
+        columns,
+        store=FeatureStore() if args.incremental else None
+    ).to_csv(
+        f"{os.getcwd()}/{args.output or args.target}", index=False
+    )
@@ -0,0 +1,151 @@
+"""
+Inference engine of the stacking model
+
+The fitted boosters are kept as their native objects (xgboost.Booster,
+lightgbm.Booster, catboost.CatBoost) next to the Ridge weights, and the
+input is a contiguous float32 matrix in the columns.json order. A predict
+call is then one native call per booster and a dot product, without the
+sklearn wrappers, their pandas validation or any dtype conversion.
+
+Example:
+    predictor = StackPredictor.from_artifact(Artifact("models/stack"))
+    log_price = predictor.predict(x_data)   # (n, len(predictor.columns)) float32
+"""
+from typing import Callable, Dict, List
+import numpy as np
+
+LIBRARIES = {
+    'XGBRegressor': 'xgboost',
+    'LGBMRegressor': 'lightgbm',
+    'CatBoostRegressor': 'catboost',
+}
+
+
+def fitted_parts(model) -> tuple:
+    """
+    (name -> fitted base learner, fitted final estimator) of a
+    ParallelStacking or a sklearn StackingRegressor, in the order of the
+    final estimator columns
+    """
+    names = [name for name, _ in model.estimators]
+    if hasattr(model, 'named_estimators_'):
+        return {name: model.named_estimators_[name] for name in names}, model.final_estimator_
+    return {name: model.estimators_[name] for name in names}, model.final_estimator
+
+
+def native_booster(estimator) -> tuple:
+    """
+    (library, native booster) of a fitted sklearn style base learner, the
+    xgboost booster is a copy since its thread parameter is set by bind
+    """
+    library = LIBRARIES[type(estimator).__name__]
+    if library == 'xgboost':
+        return library, estimator.get_booster().copy()
+    if library == 'lightgbm':
+        return library, estimator.booster_
+    ## CatBoostRegressor is a CatBoost
+    return library, estimator
+
+
+class StackPredictor:
+    """
+    Native boosters + Ridge weights, float32 matrix in, log price out
+    """
+    def __init__(
+            self,
+            boosters: Dict[str, tuple],
+            coef: Dict[str, float],
+            intercept: float,
+            columns: List[str],
+            n_threads: int = -1
+        ) -> None:
+        """
+        Args:
+            boosters (dict): name -> (library, native booster)
+            coef (dict): name -> Ridge weight of the booster
+            intercept (float): Ridge intercept
+            columns (List[str]): feature order of the input
+            n_threads (int): threads of every booster, -1 for all cores
+        """
+        self.names = list(boosters)
+        self.boosters = boosters
+        self.coef = np.array([coef[name] for name in self.names], dtype=np.float64)
+        self.intercept = float(intercept)
+        self.columns = list(columns)
+        self.n_threads = n_threads
+        self.calls = [self.bind(*boosters[name]) for name in self.names]
+
+
+    @classmethod
+    def from_artifact(cls, artifact, n_threads: int = -1) -> "StackPredictor":
+        """
+        Predictor of a saved Artifact, every booster is loaded
+        """
+        boosters = {
+            name: (info['library'], artifact.model(name))
+            for name, info in artifact.manifest['models'].items()
+        }
+        return cls(boosters, artifact.coef, artifact.intercept, artifact.columns, n_threads)
+
+
+    @classmethod
+    def from_model(cls, model, columns: List[str], n_threads: int = -1) -> "StackPredictor":
+        """
+        Predictor of a fitted ParallelStacking / StackingRegressor
+        """
+        estimators, final_estimator = fitted_parts(model)
+        return cls(
+            {name: native_booster(estimator) for name, estimator in estimators.items()},
+            dict(zip(estimators, np.ravel(final_estimator.coef_))),
+            np.ravel(final_estimator.intercept_)[0],
+            columns,
+            n_threads
+        )
+
+
+    def bind(self, library: str, booster) -> Callable[[np.ndarray], np.ndarray]:
+        """
+        Native predict call of a booster with its options fixed
+        """
+        if library == 'xgboost':
+            if self.n_threads > 0:
+                booster.set_param({'nthread': self.n_threads})
+            return lambda x_data: booster.inplace_predict(x_data, validate_features=False)
+        if library == 'lightgbm':
+            num_threads = max(self.n_threads, 0)
+            return lambda x_data: booster.predict(x_data, num_threads=num_threads)
+        thread_count = self.n_threads if self.n_threads > 0 else -1
+        return lambda x_data: booster.predict(x_data, thread_count=thread_count)
+
+
+    def check(self, x_data: np.ndarray) -> np.ndarray:
+        """
+        The input as a 2-D C contiguous float32 matrix, copied only if it is not one
+        """
+        x_data = np.ascontiguousarray(x_data, dtype=np.float32)
+        if x_data.ndim == 1:
+            x_data = x_data.reshape(1, -1)
+        if x_data.ndim != 2 or x_data.shape[1] != len(self.columns):
+            raise ValueError(
+                f"Expected a (n, {len(self.columns)}) matrix in the columns.json order, "
+                f"got {x_data.shape}"
+            )
+        return x_data
+
+
+    def predict_base(self, x_data: np.ndarray) -> np.ndarray:
+        """
+        Log price predictions of every booster, one column per model
+        """
+        x_data = self.check(x_data)
+        base = np.empty((len(x_data), len(self.calls)))
+        for i, call in enumerate(self.calls):
+            base[:, i] = np.ravel(call(x_data))
+        return base
+
+
+    def predict(self, x_data: np.ndarray) -> np.ndarray:
+        """
+        Log price prediction of the Ridge on top of the boosters
+        """
+        return self.predict_base(x_data) @ self.coef + self.intercept
@@ -1,33 +1,299 @@
 """
 Stacking script for the model
+
+The configs are read and the boosters / sklearn imported on first use,
+so importing this module does not pay for the training stack.
 """
 import os
+import json
+import time
+import hashlib
 import warnings
-from sklearn.ensemble import StackingRegressor
-from sklearn.linear_model import Ridge
-from xgboost import XGBRegressor
-from catboost import CatBoostRegressor
-from lightgbm import LGBMRegressor
+from functools import lru_cache
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+import joblib
+from joblib import Parallel, delayed
 from ..utils.data_utils import (load_data)
+from ..utils.profiling import profiled
 warnings.filterwarnings("ignore")
 
 
-xgb_config = load_data(f"{os.getcwd()}/configs/xgbr.yaml")
-cat_config = load_data(f"{os.getcwd()}/configs/catbr.yaml")
-lgbm_config = load_data(f"{os.getcwd()}/configs/lgbmr.yaml")
+CONFIGS = {
+    'xgb_config': 'xgbr',
+    'cat_config': 'catbr',
+    'lgbm_config': 'lgbmr',
+}
+
+THREAD_PARAMS = {
+    'CatBoostRegressor': 'thread_count',
+}
 
 
-def stacking() -> StackingRegressor:
+@lru_cache(maxsize=None)
+def load_config(name: str) -> dict:
+    """
+    configs/<name>.yaml, read once
+    """
+    return load_data(f"{os.getcwd()}/configs/{name}.yaml")
+
+
+def __getattr__(name: str) -> dict:
+    """
+    xgb_config / cat_config / lgbm_config, read on first access
+    """
+    if name in CONFIGS:
+        return load_config(CONFIGS[name])
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def base_learners() -> List[Tuple[str, object]]:
+    """
+    level 0 models of the stacking
+    """
+    from xgboost import XGBRegressor
+    from catboost import CatBoostRegressor
+    from lightgbm import LGBMRegressor
+
+    level_0 = list()
+    level_0.append(('xgb', XGBRegressor(**load_config('xgbr'))))
+    level_0.append(('cat', CatBoostRegressor(**load_config('catbr'))))
+    level_0.append(('lgbm', LGBMRegressor(**load_config('lgbmr'))))
+    return level_0
+
+
+def stacking():
     """
     stacking regressor
 
     Returns:
         StackingRegressor: self-defined stacking model
     """
-    level_0 = list()
-    level_0.append(('xgb', XGBRegressor(**xgb_config)))
-    level_0.append(('cat', CatBoostRegressor(**cat_config)))
-    level_0.append(('lgbm', LGBMRegressor(**lgbm_config)))
+    from sklearn.ensemble import StackingRegressor
+    from sklearn.linear_model import Ridge
+
+    level_0 = base_learners()
     level_1 = Ridge(alpha=0.5)
     stackmodel = StackingRegressor(estimators=level_0, final_estimator=level_1, cv=5)
-    return stackmodel
\ No newline at end of file
+    return stackmodel
+
+
+def take_rows(data, index: np.ndarray):
+    """
+    Rows of a DataFrame / Series / array by position
+    """
+    return data.iloc[index] if hasattr(data, 'iloc') else data[index]
+
+
+def data_hash(x: pd.DataFrame, y: pd.Series) -> str:
+    """
+    Hash of the feature set (columns + values) and the labels
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps(list(map(str, getattr(x, 'columns', [])))).encode('utf-8'))
+    sha.update(pd.util.hash_pandas_object(pd.DataFrame(x), index=False).to_numpy().tobytes())
+    sha.update(pd.util.hash_pandas_object(pd.Series(np.ravel(y)), index=False).to_numpy().tobytes())
+    return sha.hexdigest()
+
+
+def model_hash(model) -> str:
+    """
+    Hash of the model class and config, without its thread parameter
+    """
+    params = {
+        key: value for key, value in model.get_params().items()
+        if key not in ('n_jobs', 'thread_count')
+    }
+    config = json.dumps([type(model).__name__, params], sort_keys=True, default=str)
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()
+
+
+def fit_one(model, x_fit, y_fit, x_pred=None) -> Tuple[object, np.ndarray, float]:
+    """
+    Fit a single base learner, predict x_pred if given
+
+    Returns:
+        Tuple[object, np.ndarray, float]: fitted model, prediction, wall time
+    """
+    start = time.perf_counter()
+    model.fit(x_fit, y_fit)
+    pred = None if x_pred is None else model.predict(x_pred)
+    return model, pred, time.perf_counter() - start
+
+
+class ParallelStacking:
+    """
+    Same model as stacking(), but every (model x fold) fit and the full
+    refits are scheduled on a process pool. Each fit gets threads_per_fit
+    threads, so the boosters do not oversubscribe the cores.
+    """
+    def __init__(
+            self,
+            estimators: List[Tuple[str, object]] = None,
+            final_estimator=None,
+            cv: int = 5,
+            n_jobs: int = -1,
+            threads_per_fit: int = None,
+            random_state: int = None,
+            cache_dir: str = None
+        ) -> None:
+        if final_estimator is None:
+            from sklearn.linear_model import Ridge
+            final_estimator = Ridge(alpha=0.5)
+        self.estimators = base_learners() if estimators is None else estimators
+        self.final_estimator = final_estimator
+        self.cv = cv
+        self.n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+        self.threads_per_fit = threads_per_fit
+        self.random_state = random_state
+        self.cache_dir = cache_dir
+        self.estimators_ = None
+        self.fit_times_ = None
+        self.oof_ = None
+        self.y_ = None
+
+
+    def budget(self, n_tasks: int) -> Tuple[int, int]:
+        """
+        Number of worker processes and threads per fit
+        """
+        threads = self.threads_per_fit or max(1, self.n_jobs // min(n_tasks, self.n_jobs))
+        return max(1, self.n_jobs // threads), threads
+
+
+    @staticmethod
+    def with_threads(model, threads: int):
+        """
+        Clone the model with its thread parameter set
+        """
+        from sklearn.base import clone
+        param = THREAD_PARAMS.get(type(model).__name__, 'n_jobs')
+        return clone(model).set_params(**{param: threads})
+
+
+    def folds(self, x: pd.DataFrame) -> list:
+        """
+        (train, valid) positions of every fold, shuffled if random_state is set
+        """
+        from sklearn.model_selection import KFold
+        kfold = KFold(
+            n_splits=self.cv,
+            shuffle=self.random_state is not None,
+            random_state=self.random_state
+        )
+        return list(kfold.split(x))
+
+
+    def cache_path(self, name: str, model, x_hash: str) -> str:
+        """
+        Cache file prefix of a base learner, keyed by its config,
+        the feature set hash and the folds
+        """
+        key = hashlib.sha256(
+            f"{model_hash(model)}_{x_hash}_{self.cv}_{self.random_state}".encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}_{key[:16]}")
+
+
+    def load_cached(self, path: str) -> Tuple[object, np.ndarray]:
+        """
+        Fitted full model and out-of-fold predictions, None if not cached
+        """
+        if not (os.path.exists(f"{path}.joblib") and os.path.exists(f"{path}.npy")):
+            return None
+        return joblib.load(f"{path}.joblib"), np.load(f"{path}.npy")
+
+
+    @profiled(rows="x")
+    def fit(self, x: pd.DataFrame, y: pd.Series) -> "ParallelStacking":
+        """
+        Fit the base learners on the folds and on the full data,
+        then fit the final estimator on the out-of-fold predictions
+
+        With a cache_dir, the out-of-fold predictions and the full model
+        of every base learner are kept on disk, and only the base learners
+        whose config, features or folds changed are fitted again.
+        """
+        folds = self.folds(x)
+        names = [name for name, _ in self.estimators]
+        models = dict(self.estimators)
+        oof = np.zeros((len(x), len(names)))
+        self.estimators_, self.fit_times_ = {}, []
+
+        paths = {}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            x_hash = data_hash(x, y)
+            for name in names:
+                paths[name] = self.cache_path(name, models[name], x_hash)
+                cached = self.load_cached(paths[name])
+                if cached is not None:
+                    self.estimators_[name], oof[:, names.index(name)] = cached
+
+        tasks = [
+            (name, fold) for name in names if name not in self.estimators_
+            for fold in list(range(self.cv)) + [None]
+        ]
+        n_workers, threads = self.budget(max(len(tasks), 1))
+        results = Parallel(n_jobs=n_workers)(
+            delayed(fit_one)(
+                self.with_threads(models[name], threads),
+                x if fold is None else take_rows(x, folds[fold][0]),
+                y if fold is None else take_rows(y, folds[fold][0]),
+                None if fold is None else take_rows(x, folds[fold][1])
+            ) for name, fold in tasks
+        )
+
+        for (name, fold), (model, pred, seconds) in zip(tasks, results):
+            self.fit_times_.append(
+                {'model': name, 'fold': 'full' if fold is None else fold, 'seconds': seconds}
+            )
+            if fold is None:
+                self.estimators_[name] = model
+            else:
+                oof[folds[fold][1], names.index(name)] = np.ravel(pred)
+
+        for name in {name for name, _ in tasks} & set(paths):
+            joblib.dump(self.estimators_[name], f"{paths[name]}.joblib")
+            np.save(f"{paths[name]}.npy", oof[:, names.index(name)])
+
+        ## cached learners were added first, keep the order of the oof / coef_ columns
+        self.estimators_ = {name: self.estimators_[name] for name in names}
+        self.oof_, self.y_ = oof, y
+        self.final_estimator.fit(oof, y)
+        return self
+
+
+    def refit_final(self, final_estimator) -> "ParallelStacking":
+        """
+        Re-blend: fit a new final estimator on the out-of-fold predictions
+        of the last fit, without refitting any base learner
+        """
+        self.final_estimator = final_estimator
+        self.final_estimator.fit(self.oof_, self.y_)
+        return self
+
+
+    def transform(self, x: pd.DataFrame) -> np.ndarray:
+        """
+        Predictions of the fitted base learners, one column per model
+        """
+        return np.column_stack(
+            [np.ravel(self.estimators_[name].predict(x)) for name, _ in self.estimators]
+        )
+
+
+    @profiled(rows="x")
+    def predict(self, x: pd.DataFrame) -> np.ndarray:
+        """
+        Predict with the final estimator on top of the base learners
+        """
+        return self.final_estimator.predict(self.transform(x))
+
+
+    def report(self) -> pd.DataFrame:
+        """
+        Wall time of every (model x fold) fit
+        """
+        return pd.DataFrame(self.fit_times_, columns=['model', 'fold', 'seconds'])
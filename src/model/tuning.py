@@ -2,43 +2,185 @@
 Tune model parameters using Optuna
 """
 import os
+import threading
 import warnings
 import yaml
 import numpy as np
 import optuna
-from xgboost import XGBRegressor
-from catboost import CatBoostRegressor
-from lightgbm import LGBMRegressor
+import xgboost as xgb
+import lightgbm as lgb
+from xgboost.callback import TrainingCallback
+from catboost import CatBoostRegressor, Pool
 from sklearn.metrics import mean_absolute_percentage_error
+from ..utils.profiling import profiled
 warnings.filterwarnings("ignore")
 
+PRUNERS = {
+    "median": lambda: optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=50),
+    "hyperband": lambda: optuna.pruners.HyperbandPruner(min_resource=50),
+    "none": optuna.pruners.NopPruner,
+}
+
+
+def price_mape(y_true: np.ndarray, y_pred: np.ndarray) -> float:
+    """
+    MAPE (%) on the price, for models trained on the log price
+    """
+    return mean_absolute_percentage_error(np.exp(y_true), np.exp(y_pred)) * 100
+
+
+def report_round(trial: optuna.Trial, value: float, step: int) -> None:
+    """
+    Report the validation MAPE of a boosting round, prune the trial if needed
+    """
+    trial.report(value, step)
+    if trial.should_prune():
+        raise optuna.TrialPruned(f"Trial was pruned at round {step}.")
+
+
+class XGBPruning(TrainingCallback):
+    """
+    XGBoost callback reporting the validation price MAPE of every round
+    """
+    def __init__(self, trial: optuna.Trial) -> None:
+        super().__init__()
+        self.trial = trial
+
+
+    def after_iteration(self, model, epoch: int, evals_log: dict) -> bool:
+        """
+        Report the round, never stops the training by itself
+        """
+        report_round(self.trial, evals_log['validation']['price_mape'][-1], epoch)
+        return False
+
+
+class LGBMPruning:
+    """
+    LightGBM callback reporting the validation price MAPE of every round
+    """
+    def __init__(self, trial: optuna.Trial) -> None:
+        self.trial = trial
+
+
+    def __call__(self, env) -> None:
+        """
+        Report the round
+        """
+        for _, metric, value, _ in env.evaluation_result_list:
+            if metric == 'price_mape':
+                report_round(self.trial, value, env.iteration)
+
+
+class CatPruning:
+    """
+    CatBoost callback reporting the validation price MAPE of every round
+
+    CatBoost wraps the exceptions raised in callbacks, so the training is
+    stopped instead and check_pruned raises after the fit.
+    """
+    def __init__(self, trial: optuna.Trial) -> None:
+        self.trial = trial
+        self.pruned = None
+
+
+    def after_iteration(self, info) -> bool:
+        """
+        Report the round, stop the training if pruned
+        """
+        try:
+            report_round(self.trial, info.metrics['validation']['CatPriceMAPE'][-1], info.iteration)
+        except optuna.TrialPruned as pruned:
+            self.pruned = pruned
+            return False
+        return True
+
+
+    def check_pruned(self) -> None:
+        """
+        Raise the pruning of the last fit, if any
+        """
+        if self.pruned is not None:
+            raise self.pruned
+
+
+class CatPriceMAPE:
+    """
+    price MAPE as a CatBoost eval metric
+    """
+    @staticmethod
+    def is_max_optimal() -> bool:
+        """
+        Lower is better
+        """
+        return False
+
+
+    @staticmethod
+    def evaluate(approxes, target, weight) -> tuple:
+        """
+        (error, weight) of the validation set
+        """
+        return price_mape(np.asarray(target), np.asarray(approxes[0])), 1.0
+
+
+    @staticmethod
+    def get_final_error(error: float, weight: float) -> float:
+        """
+        The error is already final
+        """
+        return error
+
 
 class ParamTuner:
     """
     tune model parameters using Optuna
+
+    The DMatrix / lgb.Dataset / Pool are built once and reused by every
+    trial, and every trial stops early on the validation price MAPE.
     """
-    def __init__(self, xt, yt, xv, yv) -> None:
+    def __init__(self, xt, yt, xv, yv, early_stopping_rounds: int = 50) -> None:
         self.xt = xt
         self.yt = yt
         self.xv = xv
         self.yv = yv
+        self.early_stopping_rounds = early_stopping_rounds
+        self.datasets = {}
+        self.lock = threading.Lock()
+
+
+    def dataset(self, key, build: callable):
+        """
+        Build a training dataset once per study
+        """
+        with self.lock:
+            if key not in self.datasets:
+                self.datasets[key] = build()
+            return self.datasets[key]
 
 
-    def fit_and_evaluate_model(self, model) -> float:
+    def evaluate(self, log_pred: np.ndarray) -> float:
         """Evaluation
 
         Args:
-            model: model used
+            log_pred (np.ndarray): predicted log price of xv
 
         Returns:
             float: Mean Absolute Percentage Error
         """
-        model.fit(self.xt, self.yt)
-        y_pred = np.exp(model.predict(self.xv))
-        mape = mean_absolute_percentage_error(self.yv, y_pred)
+        mape = mean_absolute_percentage_error(self.yv, np.exp(log_pred))
         return mape * 100
 
 
+    @staticmethod
+    def record_rounds(trial, rounds_param: str, best_iteration: int) -> None:
+        """
+        Keep the early stopped number of rounds, save_yml writes it
+        instead of the suggested maximum
+        """
+        trial.set_user_attr('rounds', {rounds_param: int(best_iteration) + 1})
+
+
     def objective_xgb(self, trial):
         """
         Objective function for XGBoost
@@ -57,8 +199,28 @@ class ParamTuner:
             'reg_alpha': trial.suggest_loguniform('reg_alpha', 1e-8, 1.0),
             'random_state': 42
         }
-        model = XGBRegressor(**config)
-        return self.fit_and_evaluate_model(model)
+        dtrain, dvalid = self.dataset('xgb', lambda: (
+            xgb.DMatrix(self.xt, label=self.yt),
+            xgb.DMatrix(self.xv, label=np.log(self.yv))
+        ))
+        params = {
+            key: value for key, value in config.items() if key != 'n_estimators'
+        }
+        params['disable_default_eval_metric'] = 1
+        booster = xgb.train(
+            params,
+            dtrain,
+            num_boost_round=config['n_estimators'],
+            evals=[(dvalid, 'validation')],
+            custom_metric=lambda pred, data: ('price_mape', price_mape(data.get_label(), pred)),
+            early_stopping_rounds=self.early_stopping_rounds,
+            callbacks=[XGBPruning(trial)],
+            verbose_eval=False
+        )
+        self.record_rounds(trial, 'n_estimators', booster.best_iteration)
+        return self.evaluate(
+            booster.predict(dvalid, iteration_range=(0, booster.best_iteration + 1))
+        )
 
 
     def objective_cat(self, trial):
@@ -80,14 +242,29 @@ class ParamTuner:
             'verbose': False,
             'random_state': 42
         }
-        model = CatBoostRegressor(**config)
-        return self.fit_and_evaluate_model(model)
+        train_pool, valid_pool = self.dataset('cat', lambda: (
+            Pool(self.xt, label=self.yt),
+            Pool(self.xv, label=np.log(self.yv))
+        ))
+        model = CatBoostRegressor(
+            **config,
+            eval_metric=CatPriceMAPE(),
+            early_stopping_rounds=self.early_stopping_rounds
+        )
+        pruning = CatPruning(trial)
+        model.fit(train_pool, eval_set=valid_pool, use_best_model=True, callbacks=[pruning])
+        pruning.check_pruned()
+        self.record_rounds(trial, 'iterations', model.get_best_iteration())
+        return self.evaluate(model.predict(valid_pool))
 
 
     def objective_lgbm(self, trial):
         """
         Objective function for LightGBM
 
+        max_bin is a dataset parameter, so it is searched on a grid of
+        64 and one lgb.Dataset is kept per value.
+
         Args:
             trial
 
@@ -102,8 +279,8 @@ class ParamTuner:
             'feature_fraction': trial.suggest_uniform('feature_fraction', 0.4, 1.0),
             'bagging_fraction': trial.suggest_uniform('bagging_fraction', 0.4, 1.0),
             'random_state': 42,
-            "metric": "mape",
-            "num_iterations": trial.suggest_int("num_iterations", 400, 1000), 
+            "metric": "None",
+            "num_iterations": trial.suggest_int("num_iterations", 400, 1000),
             "verbosity": -1,
             "bagging_freq": 1,
             "learning_rate": trial.suggest_float("learning_rate", 1e-3, 1e-1, log=True),
@@ -111,47 +288,86 @@ class ParamTuner:
             "subsample": trial.suggest_float("subsample", 0.5, 1.0),
             "colsample_bytree": trial.suggest_float("colsample_bytree", 0.1, 1.0),
             "min_data_in_leaf": trial.suggest_int("min_data_in_leaf", 10, 100),
-            "max_bin": trial.suggest_int("max_bin", 128, 512),
+            "max_bin": trial.suggest_int("max_bin", 128, 512, step=64),
         }
-        model = LGBMRegressor(**config)
-        return self.fit_and_evaluate_model(model)
 
+        def build():
+            dataset_params = {'max_bin': config['max_bin'], 'feature_pre_filter': False, 'verbosity': -1}
+            dtrain = lgb.Dataset(self.xt, label=self.yt, params=dataset_params, free_raw_data=False)
+            dvalid = lgb.Dataset(self.xv, label=np.log(self.yv), reference=dtrain, free_raw_data=False)
+            return dtrain.construct(), dvalid.construct()
+
+        dtrain, dvalid = self.dataset(('lgbm', config['max_bin']), build)
+        booster = lgb.train(
+            config,
+            dtrain,
+            valid_sets=[dvalid],
+            feval=lambda pred, data: ('price_mape', price_mape(data.get_label(), pred), False),
+            callbacks=[
+                lgb.early_stopping(self.early_stopping_rounds, verbose=False),
+                LGBMPruning(trial)
+            ]
+        )
+        best_iteration = booster.best_iteration or config['num_iterations']
+        self.record_rounds(trial, 'num_iterations', best_iteration - 1)
+        return self.evaluate(booster.predict(self.xv, num_iteration=best_iteration))
 
+
+    @profiled()
     def optimize(
             self, objective: callable,
-            n_trials: int = 100
+            n_trials: int = 100,
+            n_jobs: int = 1,
+            timeout: float = None,
+            pruner: str = "median",
+            storage: str = None,
+            study_name: str = None
         ) -> dict:
         """Optimie model parameters using Optuna
 
+        Several processes can share one study by giving them the same
+        storage (e.g. "sqlite:///optuna.db") and study_name.
+
         Args:
-            objective (callable): model objective function
-            x_train (pd.DataFrame)
-            y_train (pd.Series)
-            x_valid (pd.DataFrame)
-            y_valid (pd.Series)
+            objective (callable): model objective function, takes the trial
             n_trials (int, optional): Tries. Defaults to 100.
+            n_jobs (int, optional): Parallel trials in this process. Defaults to 1.
+            timeout (float, optional): Wall clock budget in seconds. Defaults to None.
+            pruner (str, optional): "median", "hyperband" or "none". Defaults to "median".
+            storage (str, optional): Optuna storage url. Defaults to None (in memory).
+            study_name (str, optional): Study shared through the storage. Defaults to None.
 
         Returns:
-            dict: best parameters
+            dict: best parameters, with the early stopped number of rounds
         """
-        study = optuna.create_study(direction='minimize')
+        study = optuna.create_study(
+            direction='minimize',
+            pruner=PRUNERS[pruner](),
+            storage=storage,
+            study_name=study_name,
+            load_if_exists=storage is not None
+        )
         study.optimize(
-            lambda trial: objective(
-                trial, self.xt, self.yt, self.xv, self.yv
-            ), n_trials=n_trials
+            objective, n_trials=n_trials, n_jobs=n_jobs, timeout=timeout
         )
-        return study.best_params
+        return {**study.best_params, **study.best_trial.user_attrs.get('rounds', {})}
 
 
     def save_yml(self, file_path: str, params: dict) -> None:
         """Save parameters to yaml file
 
+        The tuned parameters (with the early stopped number of rounds) are
+        written over the ones of an existing config, its other keys are kept.
+
         Args:
             file_path (str): yaml file
             params (dict): best parameters
         """
-        if not file_path not in os.listdir(f'{os.getcwd()}/configs'):
-            with open(file_path, 'w', encoding="utf-8") as yaml_file:
-                yaml.dump(params, yaml_file, default_flow_style=False)
-        else:
-            print(f'{file_path} already exists')
\ No newline at end of file
+        config = {}
+        if os.path.exists(file_path):
+            with open(file_path, encoding="utf-8") as yaml_file:
+                config = yaml.safe_load(yaml_file) or {}
+        config.update(params)
+        with open(file_path, 'w', encoding="utf-8") as yaml_file:
+            yaml.dump(config, yaml_file, default_flow_style=False, sort_keys=False)
+        print(f'tuned parameters saved to {file_path}')
@@ -5,10 +5,11 @@ import os
 import json
 from argparse import ArgumentParser
 import numpy as np
-from sklearn.metrics import mean_absolute_percentage_error
 from .preproc import PreProc
-from .model.stacking import stacking
-from .model.tuning import ParamTuner
+from .utils.feature_store import FeatureStore
+from .model.stacking import ParallelStacking
+from .artifact import save_artifact
+from .utils.profiling import PROFILER
 
 
 def parse_args() -> ArgumentParser:
@@ -28,7 +29,58 @@ def parse_args() -> ArgumentParser:
         "--tune", action="store_true"
     )
     parser.add_argument(
-        "--model_to_tune", type=str, default="xgb"
+        "--model_to_tune", type=str, default="xgbr"
+    )
+    parser.add_argument(
+        "--n_trials", type=int, default=100,
+        help="Number of tuning trials"
+    )
+    parser.add_argument(
+        "--tune_jobs", type=int, default=1,
+        help="Parallel tuning trials in this process"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None,
+        help="Wall clock budget of the tuning in seconds"
+    )
+    parser.add_argument(
+        "--pruner", type=str, default="median", choices=["median", "hyperband", "none"]
+    )
+    parser.add_argument(
+        "--storage", type=str, default=None,
+        help="Optuna storage shared by several tuning processes, e.g. sqlite:///optuna.db"
+    )
+    parser.add_argument(
+        "--n_jobs", type=int, default=-1,
+        help="Cores for the stacking fits, -1 for all"
+    )
+    parser.add_argument(
+        "--threads_per_fit", type=int, default=None,
+        help="Threads of every base learner fit, default n_jobs / number of fits"
+    )
+    parser.add_argument(
+        "--oof_cache", type=str, default=None,
+        help="Directory to cache the out-of-fold predictions of the base learners"
+    )
+    parser.add_argument(
+        "--oof_encoding", type=int, default=None,
+        help="Folds of the out-of-fold beta encoding of the training rows"
+    )
+    parser.add_argument(
+        "--save_model", type=str, default=None,
+        help="Artifact directory of the fitted model and encoders for python -m src.predict"
+    )
+    parser.add_argument(
+        "--feature_store", action="store_true",
+        help="Load the stages from data/feature_store instead of the csv files"
+    )
+    parser.add_argument(
+        "--profile_report", type=str, default=None,
+        help="Write the stage timings to <path>.json and <path>.csv, e.g. reports/run"
+    )
+    parser.add_argument(
+        "--profile_stage", type=str, default=None,
+        help="Run the first call of a stage under cProfile, e.g. ParallelStacking.fit"
     )
     return parser.parse_args()
 
@@ -39,47 +91,85 @@ if __name__ == "__main__":
 
     TARGET_PATH = f"{os.getcwd()}/data/training_data.csv"
     args = parse_args()
+    store = FeatureStore()
+    PROFILER.enable(args.profile_stage)
+
+    def data_path(name: str) -> str:
+        """
+        csv file of a stage, or its feature group with --feature_store
+        """
+        return store.file(name) if args.feature_store else f"{os.getcwd()}/data/{name}.csv"
+
     train_preproc = PreProc(
-        f"{os.getcwd()}/data/training_data.csv",
-        f"{os.getcwd()}/data/train_feat.csv",
-        f"{os.getcwd()}/data/train_output.csv",
-        "train"
+        data_path("training_data"),
+        data_path("train_feat"),
+        data_path("train_output"),
+        "train",
+        cols
     )
     private_preproc = PreProc(
-        f"{os.getcwd()}/data/private_dataset_org.csv",
-        f"{os.getcwd()}/data/private_dataset.csv",
+        data_path("private_dataset_org"),
+        data_path("private_dataset"),
         None,
-        "private"
+        "private",
+        cols
     )
     test_preproc = PreProc(
-        f"{os.getcwd()}/data/public_dataset.csv",
-        f"{os.getcwd()}/data/test_feat.csv",
+        data_path("public_dataset"),
+        data_path("test_feat"),
         None,
-        "test"
+        "test",
+        cols
     )
     train_x, train_y = train_preproc.select_features(**cols)
     private_x = private_preproc.select_features(**cols)
     test_x = test_preproc.select_features(**cols)
     x_tr, x_vl, y_tr, y_vl, test_x, private_x = train_preproc.encode_cat_features(
-        cols['cat_cols'], train_x, test_x, private_x, train_y
+        cols['cat_cols'], train_x, test_x, private_x, train_y, args.oof_encoding
+    )
+    stack_model = ParallelStacking(
+        n_jobs=args.n_jobs,
+        threads_per_fit=args.threads_per_fit,
+        cache_dir=args.oof_cache
     )
-    stack_model = stacking()
     stack_model.fit(x_tr, y_tr)
+    print(stack_model.report().groupby('model')['seconds'].describe())
     y_pred = stack_model.predict(x_vl)
     y_pred = np.exp(y_pred)
+    from sklearn.metrics import mean_absolute_percentage_error
     mape = mean_absolute_percentage_error(y_vl, y_pred)
     print(f"MAPE: {mape} * 100")
 
+    if args.save_model:
+        save_artifact(
+            args.save_model, stack_model, train_preproc.vocab,
+            train_preproc.beta_encoders, cols, x_tr.columns, x_check=x_vl
+        )
+
     if args.tune:
+        ## optuna and the booster training APIs are only needed for tuning
+        from .model.tuning import ParamTuner
         tuner = ParamTuner(x_tr, y_tr, x_vl, y_vl)
         model_dict = {
-            "xgbr": tuner.opjective_xgb,
+            "xgbr": tuner.objective_xgb,
             "lgbmr": tuner.objective_lgbm,
             "catbr": tuner.objective_cat
         }
-        best_params = tuner.optimize(model_dict[args.model_to_tune])
-
         if args.model_to_tune not in model_dict.keys():
             raise ValueError("Invalid model to tune")
 
+        best_params = tuner.optimize(
+            model_dict[args.model_to_tune],
+            n_trials=args.n_trials,
+            n_jobs=args.tune_jobs,
+            timeout=args.timeout,
+            pruner=args.pruner,
+            storage=args.storage,
+            study_name=args.model_to_tune if args.storage else None
+        )
+
         tuner.save_yml(f"{os.getcwd()}/configs/{args.model_to_tune}.yaml", best_params)
+
+    print(PROFILER.summary())
+    if args.profile_report:
+        PROFILER.save(args.profile_report)
@@ -0,0 +1,201 @@
+"""
+Batch scoring with a saved stacking model
+
+The input is streamed in fixed size chunks, every chunk gets its missing
+features built, is encoded with the saved vocabulary / beta encoders and
+its ID,predicted_price rows are appended to the output, so the memory is
+bounded by the chunk size.
+
+Example:
+    python -m src.predict --model models/stack \
+        --input data/public_dataset.csv --output data/pred.csv
+"""
+import json
+from argparse import ArgumentParser
+from typing import Iterator
+import numpy as np
+import pandas as pd
+from .artifact import Artifact
+
+SOC_ECON_COLS = ['avg_tax', 'density', 'edu_p']
+
+
+def iter_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Stream a .csv / .parquet file in chunks of chunk_size rows
+    """
+    if path.split(".")[-1] == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    elif path.split(".")[-1] == "csv":
+        yield from pd.read_csv(path, encoding='utf-8', chunksize=chunk_size)
+    else:
+        raise ValueError("File type not supported.")
+
+
+class BatchScorer:
+    """
+    Score listings with a saved stacking model, chunk by chunk
+    """
+    def __init__(
+            self,
+            model_path: str,
+            k: int = 3,
+            n_jobs: int = 1,
+            cache_size: int = 0,
+            cache_path: str = None
+        ) -> None:
+        self.artifact = Artifact(model_path)
+        self.cols = self.artifact.cols
+        self.k = k
+        self.n_jobs = n_jobs
+        self.builder = None
+        self.village = None
+        self.cache = None
+        if cache_size > 0 or cache_path is not None:
+            from .prediction_cache import PredictionCache
+            self.cache = PredictionCache(
+                self.artifact.predict, self.artifact.columns, cache_size, cache_path,
+                fingerprint=json.dumps(self.artifact.manifest, sort_keys=True)
+            )
+
+
+    def spatial_builder(self):
+        """
+        Facility KD-trees, created on first use
+        """
+        if self.builder is None:
+            from .features.spatial_builder import SpatialFeatureBuilder
+            self.builder = SpatialFeatureBuilder(None, k=self.k, n_jobs=self.n_jobs)
+        return self.builder
+
+
+    def village_index(self):
+        """
+        Village polygon index, loaded on first use
+        """
+        if self.village is None:
+            from .features.soc_econ import VillageIndex
+            self.village = VillageIndex.load()
+        return self.village
+
+
+    def warm(self) -> None:
+        """
+        Load every model, encoder, facility KD-tree and the village index
+        up front, so the first prediction is as fast as the next ones
+        """
+        for name in self.artifact.manifest['models']:
+            self.artifact.model(name)
+        _ = self.artifact.vocab, self.artifact.beta_encoders
+
+        builder = self.spatial_builder()
+        for name in builder.plan(self.cols['feat_cols']):
+            builder.get_facility(name)
+        if any(col in self.cols['feat_cols'] for col in SOC_ECON_COLS):
+            self.village_index()
+
+
+    def build_features(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """
+        Build the features of columns.json missing from the chunk, the ones
+        without source data (facility table, road network) must be in the chunk
+        """
+        missing = [col for col in self.cols['feat_cols'] if col not in chunk.columns]
+
+        if any(col.startswith(('avg_distances_', 'N_')) for col in missing):
+            spatial = self.spatial_builder().build(missing, chunk).drop(columns=['ID'])
+            chunk = pd.concat([chunk, spatial], axis=1)
+
+        if any(col in missing for col in SOC_ECON_COLS):
+            from .features.soc_econ import add_social_economic_feature
+            chunk = add_social_economic_feature(chunk, self.village_index())
+
+        for col in missing:
+            if col.startswith('縣市_') and col not in chunk.columns:
+                chunk[col] = (chunk['縣市'] == col.split('_', 1)[1]).astype(np.int8)
+
+        if '縣市_鄉鎮市區' not in chunk.columns:
+            chunk['縣市_鄉鎮市區'] = chunk['縣市'].astype(object) + '_' + chunk['鄉鎮市區'].astype(object)
+
+        ## the model was trained on real values, a NaN column would be a silent skew
+        unbuilt = [col for col in missing if col not in chunk.columns]
+        if unbuilt:
+            raise ValueError(
+                f"No source data to build {unbuilt}, pass these columns in the input"
+            )
+        return chunk
+
+
+    def predict(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """
+        ID,predicted_price of a raw chunk
+        """
+        x_data = self.artifact.encode(self.build_features(chunk))
+        predictor = self.artifact if self.cache is None else self.cache
+        return pd.DataFrame(
+            {'ID': chunk['ID'].to_numpy(), 'predicted_price': np.exp(predictor.predict(x_data))}
+        )
+
+
+    def score_file(self, input_path: str, output_path: str, chunk_size: int = 50000) -> int:
+        """
+        Score a whole file, the output is written chunk by chunk
+
+        Returns:
+            int: number of scored rows
+        """
+        n_rows = 0
+        for i, chunk in enumerate(iter_chunks(input_path, chunk_size)):
+            pred = self.predict(chunk.reset_index(drop=True))
+            pred.to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            n_rows += len(pred)
+            print(f"scored {n_rows} rows")
+        if self.cache is not None:
+            print(f"prediction cache: {self.cache.stats()}")
+        return n_rows
+
+
+def parse_args() -> ArgumentParser:
+    """
+    parsing arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--model", type=str, required=True,
+        help="Artifact directory saved by python -m src.pipeline --save_model"
+    )
+    parser.add_argument(
+        "--input", type=str, required=True,
+        help="Listings to score, .csv or .parquet"
+    )
+    parser.add_argument(
+        "--output", type=str, default="data/pred.csv",
+        help="Output csv with ID,predicted_price"
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=50000,
+        help="Rows per chunk"
+    )
+    parser.add_argument(
+        "--n_jobs", type=int, default=1,
+        help="Workers for the KD-tree queries, -1 for all cores"
+    )
+    parser.add_argument(
+        "--cache_size", type=int, default=0,
+        help="Predictions kept in the in-memory LRU cache, 0 to disable"
+    )
+    parser.add_argument(
+        "--cache_path", type=str, default=None,
+        help="sqlite file backing the prediction cache across runs"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    scorer = BatchScorer(
+        args.model, n_jobs=args.n_jobs, cache_size=args.cache_size, cache_path=args.cache_path
+    )
+    scorer.score_file(args.input, args.output, args.chunk_size)
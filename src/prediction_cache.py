@@ -0,0 +1,149 @@
+"""
+Prediction cache of the scoring side
+
+The same building is listed again and again with identical encoded
+features, so the stacking output is cached per encoded feature row: the
+key is a 128 bit blake2b hash of the row bytes, keyed by the model
+fingerprint so that a shared disk cache never serves the output of another
+model. Rows are looked up in an in-memory LRU, then in the optional sqlite
+file, and only the remaining unique rows are predicted.
+"""
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List
+import numpy as np
+import pandas as pd
+
+## sqlite limits the number of bound parameters of a statement
+SQL_BATCH = 500
+
+
+class PredictionCache:
+    """
+    LRU (+ optional sqlite) cache in front of a predict function
+    """
+    def __init__(
+            self,
+            predict: Callable[[np.ndarray], np.ndarray],
+            columns: List[str],
+            maxsize: int = 100000,
+            path: str = None,
+            fingerprint: str = ""
+        ) -> None:
+        self.predict_rows = predict
+        self.columns = columns
+        self.maxsize = maxsize
+        self.key = hashlib.sha256(fingerprint.encode("utf-8")).digest()
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.rows = self.memory_hits = self.disk_hits = self.computed = 0
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, value REAL)"
+            )
+
+
+    def row_keys(self, x_data: np.ndarray) -> List[bytes]:
+        """
+        Hash of every row, -0.0 is folded into 0.0
+        """
+        x_data = np.ascontiguousarray(x_data, dtype=np.float64) + 0.0
+        return [
+            hashlib.blake2b(row.tobytes(), digest_size=16, key=self.key).digest()
+            for row in x_data
+        ]
+
+
+    def remember(self, key: bytes, value: float) -> None:
+        """
+        Put a prediction in the LRU, evicting the least recently used
+        """
+        if self.maxsize <= 0:
+            return
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+
+    def load(self, keys: List[bytes]) -> Dict[bytes, float]:
+        """
+        Predictions of the keys found in the sqlite file
+        """
+        found = {}
+        for start in range(0, len(keys), SQL_BATCH):
+            batch = keys[start:start + SQL_BATCH]
+            found.update(self.db.execute(
+                f"SELECT key, value FROM predictions WHERE key IN ({','.join('?' * len(batch))})",
+                batch
+            ).fetchall())
+        return found
+
+
+    def predict(self, x_data) -> np.ndarray:
+        """
+        Predictions of the encoded rows, from the cache when possible. The
+        lock only guards the lookup and the insert, the model runs outside
+        of it, so two threads missing the same row may both predict it
+        """
+        if isinstance(x_data, pd.DataFrame):
+            x_data = x_data[self.columns].to_numpy(dtype=np.float64)
+        keys = self.row_keys(x_data)
+        preds = np.empty(len(keys))
+
+        with self.lock:
+            missing = {}
+            for i, key in enumerate(keys):
+                value = self.memory.get(key)
+                if value is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    self.memory.move_to_end(key)
+                    preds[i] = value
+            self.rows += len(keys)
+            self.memory_hits += len(keys) - sum(map(len, missing.values()))
+
+            if missing and self.db is not None:
+                for key, value in self.load(list(missing)).items():
+                    positions = missing.pop(key)
+                    preds[positions] = value
+                    self.disk_hits += len(positions)
+                    self.remember(key, value)
+
+        if not missing:
+            return preds
+        values = self.predict_rows(x_data[[positions[0] for positions in missing.values()]])
+        for positions, value in zip(missing.values(), values):
+            preds[positions] = value
+
+        with self.lock:
+            for key, value in zip(missing, values):
+                self.remember(key, float(value))
+            self.computed += len(missing)
+            if self.db is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO predictions VALUES (?, ?)",
+                    [(key, float(value)) for key, value in zip(missing, values)]
+                )
+                self.db.commit()
+        return preds
+
+
+    def stats(self) -> dict:
+        """
+        Rows looked up, where they were served from, and the hit rate
+        (share of the rows which did not need the model)
+        """
+        return {
+            'rows': self.rows,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'computed': self.computed,
+            'hit_rate': 1 - self.computed / self.rows if self.rows else None,
+            'size': len(self.memory)
+        }
@@ -11,11 +11,9 @@ import warnings
 from typing import List, Tuple, Union
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from sklearn.preprocessing import LabelEncoder
-from sklearn.model_selection import train_test_split
-from .utils.data_utils import load_data
-from .encoder import BetaEncoder
+from .utils.data_utils import load_data, load_typed
+from .encoder import BetaEncoder, CategoryVocab
+from .utils.profiling import profiled, stage
 
 warnings.filterwarnings('ignore')
 
@@ -28,13 +26,25 @@ class PreProc:
             raw_data_path: str,
             feat_data_path: str,
             target_path: str,
-            _type: str
+            _type: str,
+            cols: dict = None
         ) -> None:
-        self.raw_data = load_data(raw_data_path) ## raw1
-        self.feat_data = load_data(feat_data_path) ## feat1
-        self.target_data = load_data(target_path) ## target1
-        self.raw_data['縣市_鄉鎮市區'] = self.raw_data['縣市'] + '_' + self.raw_data['鄉鎮市區']
+        with stage(f"PreProc.load_{_type}") as record:
+            if cols is not None:
+                raw_cols = ['縣市', '鄉鎮市區', '單價'] + cols['cat_cols']
+                self.raw_data = load_typed(raw_data_path, cols, usecols=raw_cols) ## raw1
+                self.feat_data = load_typed(feat_data_path, cols, usecols=cols['feat_cols']) ## feat1
+            else:
+                self.raw_data = load_data(raw_data_path) ## raw1
+                self.feat_data = load_data(feat_data_path) ## feat1
+            self.target_data = load_data(target_path) if target_path else None ## target1
+            record['rows'] = len(self.raw_data)
+        self.raw_data['縣市_鄉鎮市區'] = (
+            self.raw_data['縣市'].astype(object) + '_' + self.raw_data['鄉鎮市區'].astype(object)
+        )
         self.type = _type
+        self.vocab = None
+        self.beta_encoders = None
 
 
     def select_features(
@@ -54,26 +64,30 @@ class PreProc:
             return x_data
 
 
+    @profiled(rows="train_x")
     def encode_cat_features(
         self,
         cat_cols: List[str],
         train_x: pd.DataFrame,
         test_x: pd.DataFrame,
         private_x: pd.DataFrame,
-        train_y: pd.Series
+        train_y: pd.Series,
+        oof_folds: int = None,
+        vocab: CategoryVocab = None
     ) -> Tuple:
         """
         Label encoding + Beta encoding
+
+        oof_folds: K-fold out-of-fold beta encoding of the training rows
+        vocab: fitted vocabulary to reuse, by default fitted on all the splits
         """
-        for col in tqdm(cat_cols):
-            label_encoder = LabelEncoder()
-            tmp = np.concatenate([train_x[col], test_x[col]])
-            label_encoder.fit(
-                np.concatenate([tmp, private_x[col]])
-            )
-            train_x[col] = label_encoder.transform(train_x[col])
-            test_x[col] = label_encoder.transform(test_x[col])
-            private_x[col] = label_encoder.transform(private_x[col])
+        from sklearn.model_selection import train_test_split
+        if vocab is None:
+            vocab = CategoryVocab(cat_cols).fit(train_x, test_x, private_x)
+        self.vocab = vocab
+        train_x[cat_cols] = vocab.transform(train_x)
+        test_x[cat_cols] = vocab.transform(test_x)
+        private_x[cat_cols] = vocab.transform(private_x)
 
         x_tr, x_vl, y_tr, y_vl = train_test_split(
             train_x, train_y, test_size=0.2, random_state=42
@@ -84,14 +98,10 @@ class PreProc:
         y_vl.reset_index(drop=True, inplace=True)
         y_vl = np.exp(y_vl)
 
-        for col in tqdm(cat_cols):
-            beta_encoder = BetaEncoder(col)
-            beta_encoder.fit(x_tr, '單價')
-            featue_name = f"{col}_mean"
-            x_tr[featue_name] = beta_encoder.transform(x_tr, 'mean')
-            x_vl[featue_name] = beta_encoder.transform(x_vl, 'mean')
-            test_x[featue_name] = beta_encoder.transform(test_x, 'mean')
-            private_x[featue_name] = beta_encoder.transform(private_x, 'mean')
+        self.beta_encoders = BetaEncoder.fit_transform_many(
+            [x_tr, x_vl, test_x, private_x], cat_cols, '單價', ('mean',),
+            oof_folds=oof_folds
+        )
 
         x_tr = x_tr.drop(['單價'] + cat_cols, axis=1)
         x_vl = x_vl.drop(['單價'] + cat_cols, axis=1)
@@ -0,0 +1,258 @@
+"""
+Single listing prediction service
+
+Everything a prediction needs is loaded once when the service starts: the
+artifact boosters and encoders, one KD-tree per facility type and the
+village polygon index. A request then only runs the KD-tree queries, the
+encoding and the boosters. Concurrent requests are grouped into micro
+batches, so the boosters score many listings per call.
+
+Example:
+    python -m src.serve --model models/stack --port 8000
+    curl -X POST localhost:8000/predict -d '{"縣市": "台北市", "鄉鎮市區": "大安區", ...}'
+"""
+import json
+import time
+import queue
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+import pandas as pd
+from .predict import BatchScorer
+
+
+class PredictionService:
+    """
+    In-process predictor of raw listings, warm after __init__
+    """
+    def __init__(
+            self,
+            model_path: str,
+            k: int = 3,
+            n_jobs: int = 1,
+            cache_size: int = 0,
+            cache_path: str = None
+        ) -> None:
+        start = time.perf_counter()
+        self.scorer = BatchScorer(
+            model_path, k=k, n_jobs=n_jobs, cache_size=cache_size, cache_path=cache_path
+        )
+        self.scorer.warm()
+        print(f"service warm in {time.perf_counter() - start:.2f}s")
+
+
+    def predict(self, listings: List[dict]) -> List[float]:
+        """
+        Price of every listing, a listing is a dict of the raw columns
+        (縣市, 鄉鎮市區, 橫坐標, 縱坐標, building attributes, ...)
+        """
+        chunk = pd.DataFrame.from_records(listings)
+        if 'ID' not in chunk.columns:
+            chunk['ID'] = range(len(chunk))
+        return self.scorer.predict(chunk)['predicted_price'].tolist()
+
+
+    def predict_one(self, listing: dict) -> float:
+        """
+        Price of a single listing
+        """
+        return self.predict([listing])[0]
+
+
+    def stats(self) -> dict:
+        """
+        Prediction cache statistics, empty without a cache
+        """
+        return {} if self.scorer.cache is None else self.scorer.cache.stats()
+
+
+class MicroBatcher:
+    """
+    Group the listings submitted by concurrent callers into one predict
+    call, a batch is closed after max_batch listings or max_wait_ms
+    """
+    def __init__(
+            self,
+            predict: Callable[[List[dict]], List[float]],
+            max_batch: int = 64,
+            max_wait_ms: float = 5.0
+        ) -> None:
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.loop, daemon=True)
+        self.worker.start()
+
+
+    def submit(self, listing: dict) -> Future:
+        """
+        Queue a listing, the future resolves to its price
+        """
+        future = Future()
+        self.queue.put((listing, future))
+        return future
+
+
+    def next_batch(self) -> list:
+        """
+        Block for the first listing, then collect until the batch is closed
+        """
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+
+    def loop(self) -> None:
+        """
+        Worker thread, predict the batches one after the other, a failed
+        batch is predicted listing by listing so only the bad ones fail
+        """
+        while True:
+            batch = self.next_batch()
+            try:
+                preds = self.predict([listing for listing, _ in batch])
+            except Exception:  # pylint: disable=broad-except
+                ## one bad listing must not fail the other callers, retry one by one
+                for listing, future in batch:
+                    try:
+                        future.set_result(self.predict([listing])[0])
+                    except Exception as error:  # pylint: disable=broad-except
+                        future.set_exception(error)
+                continue
+            for (_, future), pred in zip(batch, preds):
+                future.set_result(pred)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """
+    Threading HTTP server with a backlog for bursts of concurrent clients
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_handler(batcher: MicroBatcher, stats: Callable[[], dict] = dict) -> type:
+    """
+    Request handler class bound to a batcher
+
+    POST /predict with a listing (or a list of listings) as JSON returns
+    {"predicted_price": price (or [prices])}, GET /health returns {"status": "ok"},
+    GET /stats returns the prediction cache statistics.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        """
+        JSON prediction endpoint
+        """
+        def send_json(self, status: int, body: dict) -> None:
+            """
+            Write a JSON response
+            """
+            payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            """
+            health check and cache statistics
+            """
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            elif self.path == '/stats':
+                self.send_json(200, stats())
+            else:
+                self.send_json(404, {'error': f"{self.path} not found"})
+
+
+        def do_POST(self) -> None:  # pylint: disable=invalid-name
+            """
+            predict the listings of the body
+            """
+            if self.path != '/predict':
+                self.send_json(404, {'error': f"{self.path} not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                listings = body if isinstance(body, list) else [body]
+                ## queue every listing first, so a list body fills one micro batch
+                futures = [batcher.submit(listing) for listing in listings]
+                preds = [future.result() for future in futures]
+            except Exception as error:  # pylint: disable=broad-except
+                self.send_json(400, {'error': str(error)})
+                return
+            self.send_json(200, {'predicted_price': preds if isinstance(body, list) else preds[0]})
+
+
+        def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+            """
+            no access log per request
+            """
+
+    return Handler
+
+
+def parse_args() -> ArgumentParser:
+    """
+    parsing arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--model", type=str, required=True,
+        help="Artifact directory saved by python -m src.pipeline --save_model"
+    )
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1",
+        help="Host to bind"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8000,
+        help="Port to bind"
+    )
+    parser.add_argument(
+        "--max_batch", type=int, default=64,
+        help="Maximum listings per micro batch"
+    )
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=5.0,
+        help="Maximum wait for a micro batch to fill, in ms"
+    )
+    parser.add_argument(
+        "--n_jobs", type=int, default=1,
+        help="Workers for the KD-tree queries, -1 for all cores"
+    )
+    parser.add_argument(
+        "--cache_size", type=int, default=100000,
+        help="Predictions kept in the in-memory LRU cache, 0 to disable"
+    )
+    parser.add_argument(
+        "--cache_path", type=str, default=None,
+        help="sqlite file backing the prediction cache across restarts"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    service = PredictionService(
+        args.model, n_jobs=args.n_jobs, cache_size=args.cache_size, cache_path=args.cache_path
+    )
+    server = PredictionServer(
+        (args.host, args.port),
+        make_handler(MicroBatcher(service.predict, args.max_batch, args.max_wait_ms), service.stats)
+    )
+    print(f"serving on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -1,20 +1,44 @@
 """
 useful utils
+
+pyarrow, pyproj and sklearn are imported by the functions which use them,
+so importing this module for load_data stays cheap.
 """
-from typing import List, Tuple, Union
+import os
+import hashlib
+from functools import lru_cache
+from typing import Dict, List, Tuple, Union
 import yaml
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-from sklearn.ensemble import RandomForestRegressor
+
+CACHE_DIR = f"{os.getcwd()}/data/cache"
+COORD_COLS = ['橫坐標', '縱坐標']
+RAW_CAT_COLS = ['縣市', '鄉鎮市區', '路名']
 
 
-def load_data(path: str) -> Union[pd.DataFrame, dict]:
+def load_data(
+        path: str,
+        usecols: List[str] = None,
+        dtype: Dict[str, str] = None
+    ) -> Union[pd.DataFrame, dict]:
     """
-    load .csv files
+    load .csv / .parquet / .feather / .yaml files
+
+    usecols: only load these columns of a table, the missing ones are ignored
+    dtype: column -> dtype of a table, the missing ones are ignored
     """
     if path.split(".")[-1] == "csv":
-        data = pd.read_csv(path, encoding='utf-8')
+        data = pd.read_csv(
+            path, encoding='utf-8',
+            usecols=None if usecols is None else lambda col: col in usecols,
+            dtype=dtype
+        )
+
+    elif path.split(".")[-1] in ("parquet", "feather"):
+        data = read_columnar(path, usecols)
+        if dtype is not None:
+            data = data.astype({col: dtype[col] for col in data.columns if col in dtype})
 
     elif path.split(".")[-1] == "yaml":
         with open(path, 'r', encoding='utf-8') as f:
@@ -25,6 +49,84 @@ def load_data(path: str) -> Union[pd.DataFrame, dict]:
     return data
 
 
+def read_columnar(path: str, usecols: List[str] = None) -> pd.DataFrame:
+    """
+    load .parquet / .feather files, only the columns in usecols if given
+    """
+    if path.split(".")[-1] == "parquet":
+        if usecols is not None:
+            import pyarrow.parquet as pq
+            schema = pq.read_schema(path)
+            usecols = [col for col in usecols if col in schema.names]
+        return pd.read_parquet(path, columns=usecols)
+
+    if usecols is not None:
+        ## feather v2 is the Arrow IPC file format, its schema is in the footer
+        import pyarrow as pa
+        with pa.memory_map(path) as source:
+            schema = pa.ipc.open_file(source).schema
+        usecols = [col for col in usecols if col in schema.names]
+    return pd.read_feather(path, columns=usecols)
+
+
+def schema_dtypes(cols: dict) -> Dict[str, str]:
+    """
+    dtypes of the columns in columns.json
+
+    float32 for the features (float64 for the coordinates), int8 for
+    the one-hot 縣市_ columns and category for the categorical ones
+    """
+    dtypes = {}
+    for col in cols['feat_cols']:
+        if col in COORD_COLS:
+            dtypes[col] = 'float64'
+        elif col.startswith('縣市_'):
+            dtypes[col] = 'int8'
+        else:
+            dtypes[col] = 'float32'
+    for col in cols['cat_cols'] + RAW_CAT_COLS:
+        dtypes[col] = 'category'
+    return dtypes
+
+
+def untyped_memory(data: pd.DataFrame) -> int:
+    """
+    bytes the frame takes with the default float64 / int64 / string dtypes,
+    measured with memory_usage(deep=True) on an untyped copy of every column
+    """
+    total = 0
+    for col in data.columns:
+        values = data[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(values.cat.categories.dtype)
+        elif pd.api.types.is_float_dtype(values):
+            values = values.astype(np.float64)
+        elif pd.api.types.is_integer_dtype(values):
+            values = values.astype(np.int64)
+        total += int(values.memory_usage(index=False, deep=True))
+    return total
+
+
+def load_typed(path: str, cols: dict, usecols: List[str] = None, verbose: bool = True) -> pd.DataFrame:
+    """
+    Memory-lean loading with the dtypes of columns.json
+
+    Args:
+        path (str): .csv / .parquet / .feather file
+        cols (dict): content of columns.json
+        usecols (List[str], optional): columns to load. Defaults to all.
+        verbose (bool, optional): report the memory before / after. Defaults to True.
+    """
+    data = load_data(path, usecols=usecols, dtype=schema_dtypes(cols))
+    if verbose:
+        before, after = untyped_memory(data), data.memory_usage(deep=True).sum()
+        print(
+            f"{os.path.basename(path)}: {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB "
+            f"({len(data)} rows, {data.shape[1]} columns)"
+        )
+    return data
+
+
 def logarithm(data: pd.DataFrame) -> pd.DataFrame:
     """
     log transformation function
@@ -71,6 +173,42 @@ def one_hot_encoding(data: pd.DataFrame, cat_cols: List[str]) -> pd.DataFrame:
     return data_encoded
 
 
+@lru_cache(maxsize=None)
+def get_transformer(src_crs: str, dst_crs: str):
+    """
+    Get a (cached) pyproj transformer between two crs, always in (x, y) order
+    """
+    from pyproj import Transformer
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def project_coordinates(
+        x: np.ndarray,
+        y: np.ndarray,
+        src_crs: str = "EPSG:4326",
+        dst_crs: str = "EPSG:3826"
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Project raw coordinate arrays without building geometries
+
+    Args:
+        x (np.ndarray): x or lng
+        y (np.ndarray): y or lat
+        src_crs (str): Defaults to wgs84.
+        dst_crs (str): Defaults to twd97.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: projected x, y, NaN if the input is missing
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    new_x, new_y = get_transformer(src_crs, dst_crs).transform(x, y)
+    new_x, new_y = np.array(new_x, dtype=np.float64), np.array(new_y, dtype=np.float64)
+    missing = ~(np.isfinite(x) & np.isfinite(y))
+    new_x[missing], new_y[missing] = np.nan, np.nan
+    return new_x, new_y
+
+
 def add_coordinates(data: pd.DataFrame, method: str) -> pd.DataFrame:
     """
     function to add coordinates into a pandas DataFrame.
@@ -82,26 +220,51 @@ def add_coordinates(data: pd.DataFrame, method: str) -> pd.DataFrame:
         'twd97': ["EPSG:4326", "lng", "lat"],
         'wgs84': ["EPSG:3826", "橫坐標", "縱坐標"],
     }
-    gdf = gpd.GeoDataFrame(
-        data,
-        geometry=gpd.points_from_xy(
-            data[_map[method][1]], data[_map[method][2]]
-        ),
-        crs=_map[method][0]
-    ).to_crs(
-        epsg=int(_map[new][0].split(":")[1])
+    new_x, new_y = project_coordinates(
+        data[_map[method][1]], data[_map[method][2]],
+        _map[method][0], _map[new][0]
     )
-    new_coords = gdf.get_coordinates().rename(
-        columns={"x": _map[new][1], "y": _map[new][2]}
+    new_coords = pd.DataFrame(
+        {_map[new][1]: new_x, _map[new][2]: new_y}, index=data.index
     )
     return pd.concat([data, new_coords], axis=1)
 
 
+def file_hash(path: str) -> str:
+    """
+    sha256 of the file content
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_projected(path: str, cache_dir: str = CACHE_DIR) -> pd.DataFrame:
+    """
+    load a facility file with lat / lng and add the twd97 coordinates
+
+    The projected table is cached in cache_dir, keyed by the hash of the
+    source file, so the same file is never projected twice.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f"{name}_{file_hash(path)[:16]}.pkl")
+
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+
+    data = add_coordinates(load_data(path), method="twd97")
+    os.makedirs(cache_dir, exist_ok=True)
+    data.to_pickle(cache_path)
+    return data
+
+
 def feature_select(
         data: pd.DataFrame,
         pred_target: str,
         dims: int,
-        model=RandomForestRegressor,
+        model=None,
     ) -> Tuple[pd.DataFrame, pd.Series]:
     """
     Feature selection function
@@ -119,8 +282,11 @@ def feature_select(
         The number of important features you want to select.
     - model: sklearn model
         The model you want to use to select features.
-        default: RandomForestRegressor
+        default: RandomForestRegressor()
     """
+    if model is None:
+        from sklearn.ensemble import RandomForestRegressor
+        model = RandomForestRegressor()
     features, output = data.drop(columns=[pred_target]), data[pred_target]
     model.fit(features, output)
     feature_importance = model.feature_importances_
@@ -0,0 +1,261 @@
+"""
+Columnar feature store
+
+Every feature group (train_feat, test_feat, private_dataset, ...) is kept
+as one Parquet file with a manifest.json that records its typed columns,
+so the stages can load only the columns they need instead of parsing the
+whole csv again. Incremental updates write the new rows as part files
+next to the group file, deduplicated by key on read and merged into the
+group file every MAX_PARTS parts.
+
+Example:
+    python -m src.utils.feature_store --csv data/train_feat.csv data/test_feat.csv
+"""
+import os
+import json
+import shutil
+from argparse import ArgumentParser
+from datetime import datetime
+from typing import Callable, Dict, List
+import numpy as np
+import pandas as pd
+from .data_utils import (
+    load_data,
+    read_columnar
+)
+from .profiling import stage
+
+STORE_DIR = f"{os.getcwd()}/data/feature_store"
+## appended part files of a group before they are merged into its file
+MAX_PARTS = 32
+
+
+class FeatureStore:
+    """
+    Parquet based feature store with a manifest
+    """
+    def __init__(self, root: str = STORE_DIR) -> None:
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.manifest = self.load_manifest()
+
+
+    def load_manifest(self) -> Dict[str, dict]:
+        """
+        Load the manifest, empty if the store does not exist yet
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, encoding="utf-8") as json_file:
+            return json.load(json_file)
+
+
+    def save_manifest(self) -> None:
+        """
+        Save the manifest
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.manifest_path, "w", encoding="utf-8") as json_file:
+            json.dump(self.manifest, json_file, ensure_ascii=False, indent=4)
+
+
+    def path(self, group: str) -> str:
+        """
+        Parquet file of a feature group, without the parts appended since
+        its last save / compaction (see file())
+        """
+        return os.path.join(self.root, f"{group}.parquet")
+
+
+    def part_dir(self, group: str) -> str:
+        """
+        Directory of the parts appended to a feature group
+        """
+        return os.path.join(self.root, f"{group}.parts")
+
+
+    def has(self, group: str) -> bool:
+        """
+        Whether the feature group is in the store
+        """
+        return group in self.manifest and os.path.exists(self.path(group))
+
+
+    def columns(self, group: str) -> Dict[str, str]:
+        """
+        Column name -> dtype of a feature group
+        """
+        return self.manifest[group]["columns"]
+
+
+    def save(self, group: str, data: pd.DataFrame, config: dict = None, key: str = None) -> None:
+        """
+        Save (overwrite) a feature group, with the configuration it was built with
+        """
+        os.makedirs(self.root, exist_ok=True)
+        data = data.reset_index(drop=True)
+        data.to_parquet(self.path(group), index=False)
+        shutil.rmtree(self.part_dir(group), ignore_errors=True)
+        self.manifest[group] = {
+            "file": os.path.basename(self.path(group)),
+            "parts": [],
+            "key": key,
+            "n_rows": len(data),
+            "columns": {col: str(dtype) for col, dtype in data.dtypes.items()},
+            "config": config,
+            "updated": datetime.now().isoformat(timespec="seconds")
+        }
+        self.save_manifest()
+
+
+    def load(self, group: str, columns: List[str] = None) -> pd.DataFrame:
+        """
+        Load a feature group, only the given columns if any. The appended
+        parts are read after the group file, the last row of a key wins
+        """
+        if not self.has(group):
+            raise KeyError(f"{group} is not in the feature store")
+        parts = self.manifest[group].get("parts", [])
+        key = self.manifest[group].get("key")
+        if not parts:
+            return read_columnar(self.path(group), columns)
+
+        usecols = None if columns is None else list(dict.fromkeys([key, *columns]))
+        data = pd.concat(
+            [read_columnar(self.path(group), usecols)] + [
+                read_columnar(os.path.join(self.part_dir(group), part), usecols)
+                for part in parts
+            ],
+            ignore_index=True
+        ).drop_duplicates(subset=key, keep="last").reset_index(drop=True)
+        return data if columns is None else data[[col for col in columns if col in data.columns]]
+
+
+    def file(self, group: str) -> str:
+        """
+        Single parquet file of a feature group, compacted first if parts
+        were appended to it
+        """
+        if self.has(group) and self.manifest[group].get("parts"):
+            self.compact(group)
+        return self.path(group)
+
+
+    def compact(self, group: str) -> None:
+        """
+        Merge the appended parts into the group file
+        """
+        entry = self.manifest[group]
+        self.save(group, self.load(group), entry.get("config"), entry.get("key"))
+
+
+    def missing_ids(self, group: str, ids: pd.Series, key: str = "ID") -> np.ndarray:
+        """
+        Mask of the ids which are not in the feature group yet
+        """
+        if not self.has(group):
+            return np.ones(len(ids), dtype=bool)
+        cached = self.load(group, [key])[key]
+        return ~ids.isin(cached).to_numpy()
+
+
+    def append(self, group: str, data: pd.DataFrame, key: str = "ID", config: dict = None) -> None:
+        """
+        Append rows to a feature group as a new part file, the new rows win
+        on duplicated keys. Only the new rows are written, the parts are
+        merged into the group file once there are MAX_PARTS of them
+        """
+        if not self.has(group):
+            self.save(group, data, config, key)
+            return
+
+        entry = self.manifest[group]
+        part = f"{len(entry['parts']):05d}.parquet"
+        os.makedirs(self.part_dir(group), exist_ok=True)
+        data.reset_index(drop=True).to_parquet(os.path.join(self.part_dir(group), part), index=False)
+        entry["parts"].append(part)
+        entry["key"] = key
+        entry["n_rows"] += len(data)
+        for col, dtype in data.dtypes.items():
+            entry["columns"].setdefault(col, str(dtype))
+        entry["config"] = config
+        entry["updated"] = datetime.now().isoformat(timespec="seconds")
+        self.save_manifest()
+
+        if len(entry["parts"]) >= MAX_PARTS:
+            self.compact(group)
+
+
+    def update(
+            self,
+            group: str,
+            target: pd.DataFrame,
+            build: Callable[[pd.DataFrame], pd.DataFrame],
+            columns: List[str],
+            key: str = "ID",
+            config: dict = None
+        ) -> pd.DataFrame:
+        """
+        Incremental feature computation keyed by listing ID
+
+        build is only called on the target rows whose key is not in the
+        group yet and must return key + columns for them. If the group
+        misses any of the columns, or was built with another config (k,
+        radii, source file hashes, ...), every row is rebuilt. The builds
+        are recorded as FeatureStore.build / .append / .rebuild stages.
+
+        Returns:
+            pd.DataFrame: key + columns for every target row, in target order
+        """
+        ## compared as stored, tuples and keys go through JSON
+        config = json.loads(json.dumps(config))
+        exists = self.has(group)
+        reusable = exists and set(columns) <= set(self.columns(group)) \
+            and self.manifest[group].get("config") == config
+
+        if reusable:
+            new = target[self.missing_ids(group, target[key], key)]
+            if len(new) > 0:
+                with stage("FeatureStore.append", rows=len(new)):
+                    self.append(group, build(new)[[key] + columns], key, config)
+        else:
+            with stage("FeatureStore.rebuild" if exists else "FeatureStore.build", rows=len(target)):
+                self.save(group, build(target)[[key] + columns], config, key)
+
+        cached = self.load(group, [key] + columns)
+        features = target[[key]].merge(cached, on=key, how="left")
+        features.index = target.index
+        return features
+
+
+    def import_csv(self, csv_path: str, group: str = None) -> str:
+        """
+        Convert a csv into a feature group, named after the file by default
+        """
+        group = group or os.path.splitext(os.path.basename(csv_path))[0]
+        self.save(group, load_data(csv_path))
+        return group
+
+
+def parse_args() -> ArgumentParser:
+    """
+    parsing arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--csv", type=str, nargs="+", required=True,
+        help="csv files to import into the feature store"
+    )
+    parser.add_argument(
+        "--root", type=str, default=STORE_DIR,
+        help="Feature store directory"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = FeatureStore(args.root)
+    for csv_file in args.csv:
+        name = store.import_csv(csv_file)
+        print(f"{csv_file} -> {store.path(name)}")
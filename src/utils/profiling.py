@@ -0,0 +1,282 @@
+"""
+Stage level timing and memory instrumentation
+
+Once PROFILER.enable() is called, every stage records its wall time, CPU
+time, peak RSS, RSS change and rows / second, and the records are written
+as a JSON / CSV run report. The peak RSS of a stage is the high-water mark
+while it runs: on Linux VmHWM is reset through /proc/self/clear_refs when
+a stage starts, elsewhere (or if the reset is not allowed) the RSS is
+sampled by a background thread. One stage can also run under cProfile, its
+.prof dump can be read with pstats or snakeviz. While disabled, the stages
+only call through, so a long running scorer does not pile up records.
+
+Example:
+    PROFILER.enable(profile_stage="ParallelStacking.fit")
+
+    with stage("load", rows=len(data)) as record:
+        ...
+        record['rows'] = len(result)
+
+    @profiled("BetaEncoder.fit", rows="df")
+    def fit(self, df, target_col): ...
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import inspect
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+## RSS sampling interval of the stages when VmHWM cannot be reset (seconds)
+SAMPLE_SECONDS = 0.01
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of the process so far (not of a stage), in MB
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## bytes on macOS, KB on Linux
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb() -> float:
+    """
+    Current resident memory of the process in MB, None without /proc
+    """
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as statm:
+            pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def hwm_mb() -> float:
+    """
+    Resident memory high-water mark (VmHWM) in MB, None without /proc
+    """
+    try:
+        with open("/proc/self/status", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_hwm() -> bool:
+    """
+    Reset VmHWM to the current RSS, False if the kernel does not allow it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+class Profiler:
+    """
+    Collect the stage records of a run
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.records = []
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.profile_stage = None
+        self.profile_path = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        ## id of the record -> peak RSS so far of every open stage, of all threads
+        self.open_peaks = {}
+        self.use_hwm = False
+        self.sampler = None
+        ## kept here since resetting VmHWM also resets ru_maxrss
+        self.process_peak = None
+
+
+    def enable(self, profile_stage: str = None, profile_path: str = None) -> None:
+        """
+        Start recording, the first call of profile_stage runs under cProfile
+        and is dumped to profile_path
+        """
+        self.enabled = True
+        self.profile_stage = profile_stage
+        if profile_stage is not None:
+            self.profile_path = profile_path or f"{os.getcwd()}/reports/{profile_stage}.prof"
+        self.process_peak = peak_rss_mb()
+        self.use_hwm = hwm_mb() is not None and reset_hwm()
+        if not self.use_hwm and current_rss_mb() is not None and self.sampler is None:
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+
+
+    def memory_mb(self) -> float:
+        """
+        High-water mark since the last reset, or the current RSS when sampling
+        """
+        return hwm_mb() if self.use_hwm else current_rss_mb()
+
+
+    def fold(self) -> None:
+        """
+        Raise the peak of every open stage to the memory now, the lock must be held
+        """
+        value = self.memory_mb()
+        if value is None:
+            return
+        self.process_peak = value if self.process_peak is None else max(self.process_peak, value)
+        for key, peak in self.open_peaks.items():
+            self.open_peaks[key] = value if peak is None else max(peak, value)
+
+
+    def sample(self, interval: float = SAMPLE_SECONDS) -> None:
+        """
+        Sampler thread, used when VmHWM cannot be reset
+        """
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                self.fold()
+
+
+    @contextmanager
+    def stage(self, name: str, rows: int = None) -> Iterator[dict]:
+        """
+        Record a stage, rows can also be set on the yielded record
+        """
+        if not self.enabled:
+            yield {"stage": name, "rows": rows}
+            return
+
+        stack = self.local.__dict__.setdefault("stack", [])
+        record = {"stage": name, "parent": stack[-1] if stack else None, "rows": rows}
+        profiler = None
+        if name == self.profile_stage:
+            self.profile_stage = None
+            profiler = cProfile.Profile()
+
+        stack.append(name)
+        with self.lock:
+            ## the open stages keep their peak so far, then the mark restarts from now
+            self.fold()
+            if self.use_hwm:
+                reset_hwm()
+            self.open_peaks[id(record)] = self.memory_mb()
+        start_rss = current_rss_mb()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(os.path.dirname(os.path.abspath(self.profile_path)), exist_ok=True)
+                profiler.dump_stats(self.profile_path)
+                print(f"cProfile of {name} -> {self.profile_path}")
+            stack.pop()
+            record["wall_seconds"] = time.perf_counter() - start_wall
+            record["cpu_seconds"] = time.process_time() - start_cpu
+            with self.lock:
+                self.fold()
+                record["peak_rss_mb"] = self.open_peaks.pop(id(record))
+            end_rss = current_rss_mb()
+            record["rss_delta_mb"] = None if end_rss is None else end_rss - start_rss
+            record["process_peak_rss_mb"] = self.process_peak
+            record["rows_per_second"] = (
+                record["rows"] / record["wall_seconds"]
+                if record["rows"] and record["wall_seconds"] > 0 else None
+            )
+            with self.lock:
+                self.records.append(record)
+
+
+    def report(self) -> pd.DataFrame:
+        """
+        One row per recorded stage, in completion order
+        """
+        return pd.DataFrame(
+            self.records,
+            columns=[
+                "stage", "parent", "rows", "wall_seconds",
+                "cpu_seconds", "peak_rss_mb", "rss_delta_mb", "process_peak_rss_mb",
+                "rows_per_second"
+            ]
+        )
+
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Calls, total wall / CPU time, largest peak RSS / RSS change and
+        process peak RSS per stage
+        """
+        return self.report().groupby("stage", sort=False).agg(
+            calls=("wall_seconds", "size"),
+            wall_seconds=("wall_seconds", "sum"),
+            cpu_seconds=("cpu_seconds", "sum"),
+            peak_rss_mb=("peak_rss_mb", "max"),
+            rss_delta_mb=("rss_delta_mb", "max"),
+            process_peak_rss_mb=("process_peak_rss_mb", "max"),
+            rows_per_second=("rows_per_second", "mean")
+        )
+
+
+    def save(self, path: str) -> None:
+        """
+        Write the run report to path.json and path.csv
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        report = self.report()
+        report.to_csv(f"{path}.csv", index=False)
+        with open(f"{path}.json", "w", encoding="utf-8") as json_file:
+            json.dump(
+                {
+                    "started": self.started,
+                    "argv": sys.argv,
+                    "stages": json.loads(report.to_json(orient="records", force_ascii=False))
+                },
+                json_file, ensure_ascii=False, indent=4
+            )
+
+
+PROFILER = Profiler()
+stage = PROFILER.stage
+
+
+def profiled(name: str = None, rows: str = None) -> Callable:
+    """
+    Decorator form of stage(), rows is the argument whose len is the number of rows
+    """
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            n_rows = None
+            if rows is not None:
+                value = signature.bind(*args, **kwargs).arguments.get(rows)
+                n_rows = None if value is None else len(value)
+            with PROFILER.stage(label, n_rows):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,72 @@
+"""
+spatial index utils
+
+All coordinates are TWD97 (EPSG:3826) metres, so plain euclidean
+distance on the (橫坐標, 縱坐標) pairs is the distance in metres.
+"""
+from typing import Iterable, Tuple, Union
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+COORD_COLS = ['橫坐標', '縱坐標']
+
+
+def to_xy(pos: Union[pd.DataFrame, np.ndarray]) -> np.ndarray:
+    """
+    Convert (x, y) positions into a contiguous (n, 2) float64 array
+    """
+    if isinstance(pos, pd.DataFrame):
+        pos = pos[COORD_COLS].to_numpy()
+    return np.ascontiguousarray(pos, dtype=np.float64).reshape(-1, 2)
+
+
+def build_tree(pos: Union[pd.DataFrame, np.ndarray]) -> cKDTree:
+    """
+    Build a KD-tree over the facility positions
+    """
+    return cKDTree(to_xy(pos))
+
+
+def count_within_radius(
+        tree: cKDTree,
+        target_pos: Union[pd.DataFrame, np.ndarray],
+        radii: Union[float, Iterable[float]],
+        n_jobs: int = 1
+    ) -> np.ndarray:
+    """
+    Count the facilities within each radius for every target
+
+    Returns:
+        np.ndarray: (n_targets, n_radii) counts, distance <= radius
+    """
+    target_xy = to_xy(target_pos)
+    radii = np.atleast_1d(np.asarray(radii, dtype=np.float64))
+    counts = np.empty((len(target_xy), len(radii)), dtype=np.int64)
+    for i, rad in enumerate(radii):
+        counts[:, i] = tree.query_ball_point(
+            target_xy, rad, return_length=True, workers=n_jobs
+        )
+    return counts
+
+
+def query_nearest(
+        tree: cKDTree,
+        target_pos: Union[pd.DataFrame, np.ndarray],
+        k: int = 1,
+        n_jobs: int = 1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the k nearest facilities for every target
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (n_targets, k) distances and indices,
+        sorted from the nearest one. Like cKDTree for the missing neighbors,
+        an empty tree gives inf distances and the index tree.n
+    """
+    n_targets = len(target_pos)
+    if tree.n == 0:
+        return np.full((n_targets, k), np.inf), np.full((n_targets, k), tree.n, dtype=np.intp)
+    k = min(k, tree.n)
+    distances, indices = tree.query(to_xy(target_pos), k=k, workers=n_jobs)
+    return distances.reshape(-1, k), indices.reshape(-1, k)
@@ -0,0 +1,60 @@
+"""
+save_artifact / Artifact round trip
+"""
+import json
+import numpy as np
+import pandas as pd
+from lightgbm import LGBMRegressor
+from sklearn.linear_model import Ridge
+from xgboost import XGBRegressor
+from src.artifact import Artifact, save_artifact
+from src.encoder import BetaEncoder, CategoryVocab
+from src.model.stacking import ParallelStacking
+
+COLS = {'feat_cols': ['area', 'age'], 'cat_cols': ['city']}
+
+
+def fitted_pipeline(n_rows: int = 300, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    raw = pd.DataFrame({
+        'area': rng.random(n_rows) * 100,
+        'age': rng.random(n_rows) * 40,
+        'city': rng.choice(['a', 'b', 'c'], n_rows)
+    })
+    y = pd.Series(np.log(raw['area'] + 1) + rng.normal(0, 0.1, n_rows))
+
+    vocab = CategoryVocab(COLS['cat_cols']).fit(raw)
+    x_data = raw.copy()
+    x_data[COLS['cat_cols']] = vocab.transform(raw)
+    encoder = BetaEncoder('city')
+    encoder.fit(x_data.assign(target=y / y.max()), 'target')
+    x_data['city_mean'] = encoder.transform(x_data, 'mean')
+
+    model = ParallelStacking(
+        [
+            ('xgb', XGBRegressor(n_estimators=10, max_depth=3)),
+            ('lgbm', LGBMRegressor(n_estimators=10, verbose=-1))
+        ],
+        final_estimator=Ridge(alpha=0.5), cv=2, n_jobs=1
+    ).fit(x_data, y)
+    return raw, x_data, model, vocab, {'city': encoder}
+
+
+def test_artifact_predicts_like_the_fitted_model(tmp_path):
+    raw, x_data, model, vocab, encoders = fitted_pipeline()
+    path = str(tmp_path / "stack")
+    save_artifact(path, model, vocab, encoders, COLS, x_data.columns, x_check=x_data)
+
+    with open(f"{path}/manifest.json", encoding="utf-8") as json_file:
+        manifest = json.load(json_file)
+    assert manifest['parity']['rows'] == len(x_data)
+    assert manifest['parity']['max_abs_diff'] <= manifest['parity']['tolerance']
+    assert manifest['final']['names'] == ['xgb', 'lgbm']
+
+    artifact = Artifact(path)
+    encoded = artifact.encode(raw)
+    pd.testing.assert_frame_equal(encoded, x_data, check_dtype=False)
+    np.testing.assert_allclose(
+        artifact.predict(encoded), model.predict(x_data.astype(np.float32)), atol=1e-6
+    )
+    assert artifact.coef == dict(zip(['xgb', 'lgbm'], model.final_estimator.coef_))
@@ -0,0 +1,51 @@
+"""
+BetaEncoder out-of-fold encoding and CategoryVocab round trip
+"""
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import KFold
+from src.encoder import BetaEncoder, CategoryVocab
+
+
+def make_frame(n_rows: int = 400, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'city': rng.choice(['a', 'b', 'c', 'd', 'e', 'rare'], n_rows, p=[.3, .3, .2, .1, .09, .01]),
+        'price': rng.random(n_rows)
+    })
+
+
+def test_oof_rows_are_encoded_with_the_other_folds_only():
+    data = make_frame()
+    encoded = BetaEncoder('city').fit_transform_oof(data, 'price', 'mean', n_splits=5, random_state=7)
+
+    kfold = KFold(n_splits=5, shuffle=True, random_state=7)
+    for fit_index, encode_index in kfold.split(data):
+        encoder = BetaEncoder('city')
+        encoder.fit(data.iloc[fit_index], 'price')
+        expected = encoder.transform(data.iloc[encode_index], 'mean')
+        np.testing.assert_allclose(encoded.iloc[encode_index], expected)
+
+
+def test_oof_encoding_ignores_the_targets_of_its_own_fold():
+    data = make_frame()
+    kfold = KFold(n_splits=5, shuffle=True, random_state=7)
+    _, fold = next(kfold.split(data))
+    changed = data.copy()
+    changed.loc[fold, 'price'] = 100.0
+
+    before = BetaEncoder('city').fit_transform_oof(data, 'price', 'mean', random_state=7)
+    after = BetaEncoder('city').fit_transform_oof(changed, 'price', 'mean', random_state=7)
+    np.testing.assert_allclose(before.iloc[fold], after.iloc[fold])
+    assert not np.allclose(np.delete(before.to_numpy(), fold), np.delete(after.to_numpy(), fold))
+
+
+def test_vocab_round_trip_keeps_non_string_categories(tmp_path):
+    train = pd.DataFrame({'s': ['b', 'a', 'b'], 'i': [3, 1, 10]})
+    test = pd.DataFrame({'s': ['c', 'a', 'z'], 'i': [2, 1, 99]})
+    vocab = CategoryVocab(['s', 'i']).fit(train, test)
+    vocab.save(str(tmp_path / "vocab.json"))
+    loaded = CategoryVocab.load(str(tmp_path / "vocab.json"))
+
+    pd.testing.assert_frame_equal(loaded.transform(test), vocab.transform(test))
+    assert loaded.vocabs['i'].dtype == np.int64
@@ -0,0 +1,60 @@
+"""
+FeatureStore incremental updates
+"""
+import pandas as pd
+from src.utils.feature_store import FeatureStore
+
+
+class Builder:
+    """
+    Feature build which records the IDs it is called on
+    """
+    def __init__(self) -> None:
+        self.calls = []
+
+
+    def __call__(self, rows: pd.DataFrame) -> pd.DataFrame:
+        self.calls.append(sorted(rows['ID']))
+        return pd.DataFrame({'ID': rows['ID'], 'double': rows['x'] * 2.0, 'square': rows['x'] ** 2})
+
+
+def listings(ids) -> pd.DataFrame:
+    return pd.DataFrame({'ID': list(ids), 'x': [float(i) for i in ids]})
+
+
+def test_update_only_builds_the_new_rows(tmp_path):
+    store, build = FeatureStore(str(tmp_path)), Builder()
+    store.update('feat', listings(range(5)), build, ['double'], config={'k': 3})
+    features = store.update('feat', listings([6, 2, 5]), build, ['double'], config={'k': 3})
+
+    assert build.calls == [[0, 1, 2, 3, 4], [5, 6]]
+    assert features['ID'].tolist() == [6, 2, 5]
+    assert features['double'].tolist() == [12.0, 4.0, 10.0]
+    assert store.manifest['feat']['parts']
+    assert sorted(FeatureStore(str(tmp_path)).load('feat')['ID']) == [0, 1, 2, 3, 4, 5, 6]
+
+
+def test_update_rebuilds_on_config_or_column_change(tmp_path):
+    store, build = FeatureStore(str(tmp_path)), Builder()
+    store.update('feat', listings(range(3)), build, ['double'], config={'k': 3})
+    store.update('feat', listings(range(3)), build, ['double'], config={'k': 5})
+    assert build.calls == [[0, 1, 2], [0, 1, 2]]
+    assert store.manifest['feat']['config'] == {'k': 5}
+
+    features = store.update('feat', listings(range(3)), build, ['double', 'square'], config={'k': 5})
+    assert build.calls[-1] == [0, 1, 2]
+    assert features['square'].tolist() == [0.0, 1.0, 4.0]
+
+    store.update('feat', listings(range(3)), build, ['double', 'square'], config={'k': 5})
+    assert len(build.calls) == 3
+
+
+def test_appended_rows_win_and_compact(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    store.save('feat', pd.DataFrame({'ID': [1, 2], 'value': [1.0, 2.0]}), key='ID')
+    store.append('feat', pd.DataFrame({'ID': [2, 3], 'value': [20.0, 3.0]}), key='ID')
+
+    assert store.load('feat', ['value'])['value'].tolist() == [1.0, 20.0, 3.0]
+    path = store.file('feat')
+    assert not store.manifest['feat']['parts']
+    assert pd.read_parquet(path)['value'].tolist() == [1.0, 20.0, 3.0]
@@ -0,0 +1,64 @@
+"""
+PredictionCache: LRU eviction, deduplication and the sqlite file
+"""
+import numpy as np
+from src.prediction_cache import PredictionCache
+
+
+class CountingModel:
+    """
+    Sum of the row, records the rows of every call
+    """
+    def __init__(self) -> None:
+        self.calls = []
+
+
+    def __call__(self, x_data: np.ndarray) -> np.ndarray:
+        self.calls.append(len(x_data))
+        return x_data.sum(axis=1)
+
+
+def test_duplicated_rows_are_predicted_once():
+    model = CountingModel()
+    cache = PredictionCache(model, ['a', 'b'], maxsize=10)
+    x_data = np.array([[1.0, 2.0], [1.0, 2.0], [3.0, 4.0], [-0.0, 0.0], [0.0, 0.0]])
+
+    np.testing.assert_allclose(cache.predict(x_data), [3.0, 3.0, 7.0, 0.0, 0.0])
+    assert model.calls == [3]
+    np.testing.assert_allclose(cache.predict(x_data[:3]), [3.0, 3.0, 7.0])
+    assert model.calls == [3]
+    assert cache.stats()['memory_hits'] == 3
+
+
+def test_lru_evicts_the_least_recently_used():
+    model = CountingModel()
+    cache = PredictionCache(model, ['a'], maxsize=2)
+    first, second, third = np.array([[1.0]]), np.array([[2.0]]), np.array([[3.0]])
+
+    cache.predict(first)
+    cache.predict(second)
+    cache.predict(first)   # first is now the most recently used
+    cache.predict(third)   # evicts second
+    assert cache.stats()['size'] == 2
+    assert model.calls == [1, 1, 1]
+
+    cache.predict(first)
+    assert model.calls == [1, 1, 1]
+    cache.predict(second)
+    assert model.calls == [1, 1, 1, 1]
+
+
+def test_sqlite_file_is_shared_by_fingerprint(tmp_path):
+    path = str(tmp_path / "predictions.db")
+    x_data = np.array([[1.0, 2.0], [3.0, 4.0]])
+    PredictionCache(CountingModel(), ['a', 'b'], path=path, fingerprint="model-a").predict(x_data)
+
+    model = CountingModel()
+    cache = PredictionCache(model, ['a', 'b'], path=path, fingerprint="model-a")
+    np.testing.assert_allclose(cache.predict(x_data), [3.0, 7.0])
+    assert model.calls == []
+    assert cache.stats()['disk_hits'] == 2
+
+    model = CountingModel()
+    PredictionCache(model, ['a', 'b'], path=path, fingerprint="model-b").predict(x_data)
+    assert model.calls == [2]
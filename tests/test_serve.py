@@ -0,0 +1,71 @@
+"""
+Micro batching of the prediction server
+"""
+import json
+import threading
+import urllib.request
+import pytest
+from src.serve import MicroBatcher, PredictionServer, make_handler
+
+
+class RecordingModel:
+    """
+    Price = area, records the size of every batch, fails on a negative area
+    """
+    def __init__(self) -> None:
+        self.batches = []
+
+
+    def __call__(self, listings):
+        self.batches.append(len(listings))
+        if any(listing['area'] < 0 for listing in listings):
+            raise ValueError("negative area")
+        return [float(listing['area']) for listing in listings]
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    model = RecordingModel()
+    batcher = MicroBatcher(model, max_batch=64, max_wait_ms=200)
+    server = PredictionServer(('127.0.0.1', 0), make_handler(batcher))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", model
+    server.shutdown()
+    server.server_close()
+
+
+def post(url: str, body) -> tuple:
+    request = urllib.request.Request(
+        f"{url}/predict", data=json.dumps(body).encode('utf-8'), method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_list_body_is_one_batch(server):
+    url, model = server
+    status, body = post(url, [{'area': area} for area in range(10)])
+
+    assert status == 200
+    assert body == {'predicted_price': [float(area) for area in range(10)]}
+    assert model.batches == [10]
+
+
+def test_single_listing_body(server):
+    url, _ = server
+    assert post(url, {'area': 3}) == (200, {'predicted_price': 3.0})
+
+
+def test_bad_listing_does_not_fail_the_batch():
+    model = RecordingModel()
+    batcher = MicroBatcher(model, max_batch=64, max_wait_ms=200)
+    good, bad = batcher.submit({'area': 1}), batcher.submit({'area': -1})
+
+    assert good.result(timeout=10) == 1.0
+    with pytest.raises(ValueError):
+        bad.result(timeout=10)
+    assert model.batches[0] == 2